@@ -1,24 +1,26 @@
-import os, logging, random, json, asyncio, requests, re, urllib.parse, sys, hashlib, time, base64, io
+import os, logging, random, json, asyncio, requests, re, urllib.parse, sys, hashlib, time, base64, io, sqlite3, importlib, multiprocessing, contextvars
+_PROCESS_T0 = time.perf_counter()
+from collections import deque, OrderedDict
+from itertools import islice
+from bisect import bisect_left, insort
 from datetime import datetime, timedelta
 from typing import Optional
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from aiohttp import web
 import aiohttp
 from bs4 import BeautifulSoup
 from telegram import Update, ReactionTypeEmoji, InlineKeyboardButton, InlineKeyboardMarkup
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReplaceOne, UpdateOne
 from telegram.ext import (
     Application as TGApp, CommandHandler, ContextTypes, MessageHandler, PollAnswerHandler,
-    CallbackQueryHandler, filters,
+    CallbackQueryHandler, TypeHandler, filters,
 )
 from telegram.constants import ParseMode
 from telegram.error import NetworkError, TimedOut, Forbidden, BadRequest, RetryAfter
-import pandas as pd, numpy as np, matplotlib
-matplotlib.use('Agg')
-import mplfinance as mpf
-import ccxt
-import feedparser, qrcode, cv2
-from PIL import Image, ImageDraw, ImageFont
-from textblob import TextBlob
+_EAGER_IMPORTS_MS = round((time.perf_counter() - _PROCESS_T0) * 1000, 1)
 
 logging.basicConfig(format="%(asctime)s [%(levelname)s] %(message)s", level=logging.INFO, handlers=[logging.StreamHandler(sys.stdout)])
 logger = logging.getLogger("Beluga")
@@ -40,7 +42,8 @@ if not BOT_TOKEN or len(BOT_TOKEN) < 20:
 mongo_client = AsyncIOMotorClient(MONGO_URL) if MONGO_URL else None
 mongo_db = mongo_client["beluga_bot"] if mongo_client else None
 mongo_memory_col = mongo_db["chat_memory"] if mongo_db is not None else None
-mongo_leaderboard_col = mongo_db["leaderboard"] if mongo_db is not None else None
+mongo_leaderboard_col = mongo_db["leaderboard"] if mongo_db is not None else None  # legacy chat-per-doc layout, read only by the migration
+mongo_scores_col = mongo_db["scores"] if mongo_db is not None else None
 mongo_weekly_col = mongo_db["weekly_winners"] if mongo_db is not None else None
 mongo_stickers_col = mongo_db["stickers"] if mongo_db is not None else None
 
@@ -49,19 +52,145 @@ FILE_STICKERS = "beluga_stickers.json"
 STICKER_PACK_MAIN = "t_me_belugapack_mystickers_by_fStikBot"
 STICKER_PACK_SAFE = "t_me_staysafebelu_by_fStikBot"
 
+BOUNDED_SWEEP_SECS = int(os.environ.get("BOUNDED_SWEEP_SECS", "60"))
+MINE_SETUP_TTL = 600  # a minesweeper left at "choose mines" this long is abandoned
+
+bounded_registry: dict = {}  # name -> BoundedDict; swept by cleanup_expired_games() and reported in /health
+bounded_stats: dict = {}  # name -> summary taken at the last sweep; /health serves this as-is
+BOUNDED_SIZE_SAMPLE = int(os.environ.get("BOUNDED_SIZE_SAMPLE", "200"))
+
+class BoundedDict(OrderedDict):
+    """
+    OrderedDict kept in last-write order, with an optional TTL (seconds since
+    a key was last assigned or touch()ed) and an optional size cap that drops
+    the oldest-written keys on insert. An expired key reads as missing and is
+    dropped on the spot; cleanup_expired_games() reclaims the ones nobody reads.
+    Values that are themselves BoundedDicts are swept too and removed once empty.
+    """
+    def __init__(self, name: str = "", ttl: float = 0, max_items: int = 0):
+        super().__init__()
+        self.ttl, self.max_items = ttl, max_items
+        self._ts = {}
+        self.stats = {"expired": 0, "evicted": 0}
+        if name:
+            bounded_registry[name] = self
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.touch(key)
+        while self.max_items and len(self) > self.max_items:
+            del self[next(iter(self))]
+            self.stats["evicted"] += 1
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._ts.pop(key, None)
+
+    def _live(self, key) -> bool:
+        """True if key is present and within its TTL; an expired key is deleted."""
+        if not super().__contains__(key):
+            return False
+        if self.ttl and time.monotonic() - self._ts.get(key, time.monotonic()) > self.ttl:
+            del self[key]
+            self.stats["expired"] += 1
+            return False
+        return True
+
+    def __contains__(self, key):
+        return self._live(key)
+
+    def __getitem__(self, key):
+        if not self._live(key):
+            raise KeyError(key)
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        return super().__getitem__(key) if self._live(key) else default
+
+    def setdefault(self, key, default=None):
+        if self._live(key):
+            return super().__getitem__(key)
+        self[key] = default
+        return default
+
+    def pop(self, key, *default):
+        self._ts.pop(key, None)
+        return super().pop(key, *default)
+
+    def popitem(self, last: bool = True):
+        key, value = super().popitem(last)
+        self._ts.pop(key, None)
+        return key, value
+
+    def clear(self):
+        super().clear()
+        self._ts.clear()
+
+    def touch(self, key):
+        """Mark a key as freshly written (for values mutated in place)."""
+        self.move_to_end(key)
+        self._ts[key] = time.monotonic()
+
+    def sweep(self, now: float) -> int:
+        removed = 0
+        if self.ttl:
+            while self:
+                key = next(iter(self))
+                if now - self._ts.get(key, now) <= self.ttl:
+                    break
+                del self[key]
+                removed += 1
+        for key, value in list(self.items()):
+            if isinstance(value, BoundedDict):
+                value.sweep(now)
+                if not value:
+                    del self[key]
+                    removed += 1
+        self.stats["expired"] += removed
+        return removed
+
+def _approx_bytes(obj, depth: int = 3) -> int:
+    """Rough deep size: sys.getsizeof over containers, a few levels down."""
+    size = sys.getsizeof(obj)
+    if depth <= 0:
+        return size
+    if isinstance(obj, dict):
+        size += sum(_approx_bytes(k, 0) + _approx_bytes(v, depth - 1) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(_approx_bytes(v, depth - 1) for v in obj)
+    return size
+
+def _sampled_bytes(d: dict) -> int:
+    """_approx_bytes() of the first BOUNDED_SIZE_SAMPLE entries, scaled up to the whole container."""
+    sample = [_approx_bytes(k, 0) + _approx_bytes(v, 2) for k, v in islice(d.items(), BOUNDED_SIZE_SAMPLE)]
+    return sys.getsizeof(d) + (sum(sample) * len(d) // len(sample) if sample else 0)
+
+def refresh_bounded_stats():
+    """Recompute bounded_stats; run by the sweeper so /health never walks the containers."""
+    bounded_stats.clear()
+    bounded_stats.update({name: {"entries": len(d), "approx_bytes": _sampled_bytes(d), "ttl": d.ttl, "max": d.max_items, **d.stats}
+                          for name, d in bounded_registry.items()})
+
 bot_status = {"running": False, "start_time": datetime.now(), "message_count": 0, "error_count": 0, "api_calls": 0, "failed_apis": 0, "username": ""}
-quiz_cooldown, active_polls, spam_tracker = {}, {}, {}
-db = {"scores": {}, "weekly": {}, "seen": {}, "counts": {}}
-fun_db = {"gay_couple_log": {}}
+quiz_cooldown = BoundedDict("quiz_cooldown", max_items=20000)  # cid -> BoundedDict(ttl=3600) of question hashes
+active_polls = BoundedDict("active_polls", ttl=86400, max_items=20000)
+spam_tracker = BoundedDict("spam_tracker", ttl=30, max_items=50000)
+SEEN_PER_CHAT_MAX = 500
+db = {"seen": BoundedDict("seen", ttl=7 * 86400, max_items=20000),  # cid -> BoundedDict(max_items=SEEN_PER_CHAT_MAX)
+      "counts": BoundedDict("counts", ttl=7 * 86400, max_items=50000)}
+fun_db = {"gay_couple_log": BoundedDict("gay_couple_log", ttl=2 * 86400, max_items=50000)}
 ttt_games, mine_games, user_in_game, game_timers, mine_timers, gm_tracker, gm_msg_lock = {}, {}, {}, {}, {}, {}, {}
-mine_play_stats = {}
-wm_sessions = {}
+mine_play_stats = BoundedDict("mine_play_stats", ttl=86400, max_items=50000)
+wm_sessions = BoundedDict("wm_sessions", ttl=3600, max_items=5000)
 
 sticker_data = {"packs": {}, "banned_packs": []}
+# Derived from sticker_data by rebuild_sticker_index() whenever packs or bans change.
+sticker_index = {"banned": frozenset(), "pool": [], "by_pack": {}}
+STICKER_REFRESH_SECS = int(os.environ.get("STICKER_REFRESH_SECS", str(6 * 3600)))
+sticker_stats = {"rebuilds": 0, "refreshes": 0, "packs_fetched": 0, "packs_changed": 0, "fetch_failures": 0}
 
 fun_cache_lock = asyncio.Lock()
 exchange_cache = {}
-cache_movers = {"ts": 0, "data": {}}
 news_cache = {"crypto": {"ts": 0, "data": []}, "ai": {"ts": 0, "data": []}, "tech": {"ts": 0, "data": []}}
 
 LB_IMAGE_URL = "https://i.postimg.cc/P5THW6RQ/file-00000000bce4720b905dc2e04c58fa80.png"
@@ -142,9 +271,27 @@ MEDALS = ["🥇","🥈","🥉","4️⃣","5️⃣","6️⃣","7️⃣","8️⃣"
 WIKI_UA = {"User-Agent": "BelugaBot/11.4"}
 G_HDR = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36", "Accept-Language": "en-US,en;q=0.9"}
 
-SENTIMENT_POSITIVE = ["😊", "😄", "❤️", "🔥", "✨", "🎉", "💖", "😻", "👍"]
-SENTIMENT_NEGATIVE = ["😢", "😠", "💔", "😤", "😭", "😞", "😿", "😡", "⚠️"]
-SENTIMENT_NEUTRAL = ["🤔", "😐", "👀", "🐾", "🎯", "📌", "💭", "🤷"]
+# Reaction emoji — restricted to Telegram's allowed reaction set so
+# set_message_reaction doesn't silently reject them.
+SENTIMENT_POSITIVE = ["😁", "❤", "🔥", "🥰", "🎉", "🤩", "😍", "👍", "💯"]
+SENTIMENT_NEGATIVE = ["😢", "😡", "💔", "😭", "😨", "🤬", "🤨"]
+SENTIMENT_NEUTRAL = ["🤔", "😐", "👀", "🐳", "🗿", "🤷", "🤓"]
+
+EMOJI_LEXICON = {
+    # category: (keywords / emoji that trigger it, reactions to pick from)
+    "laugh": (["lol", "lmao", "lmfao", "rofl", "haha+", "hehe+", "xd", "funny", "hasi", "😂", "🤣", "😆"], ["🤣", "😁"]),
+    "love": (["love", "luv", "pyaa?r", "ishq", "cute", "jaan", "babe", "baby", "kiss", "miss you", "❤️?", "😍", "🥰", "😘"], ["❤", "😍", "🥰", "😘"]),
+    "sad": (["sad", "cry(?:ing)?", "dukhi", "udaas", "hurt", "alone", "broken", "rona", "😢", "😭", "💔"], ["😢", "😭", "💔"]),
+    "angry": (["angry", "gussa", "hate", "annoying", "irritat\\w*", "wtf", "stfu", "😡", "🤬"], ["😡", "🤬", "🤨"]),
+    "wow": (["wow", "omg", "amazing", "insane", "crazy", "unbelievable", "kya baat", "🤯", "😱"], ["🤯", "🤩", "😱"]),
+    "thanks": (["thanks?", "thank you", "thx", "ty", "shukriya", "dhanyavaa?d", "🙏"], ["🙏", "🤗"]),
+    "greet": (["hi+", "hello", "hey+", "gm", "good morning", "namaste", "yo"], ["🤗", "🫡", "😇"]),
+    "sleep": (["sleep", "sleepy", "neend", "tired", "gn", "good night", "so ja", "😴"], ["😴", "🥱"]),
+    "party": (["party", "congrats?", "congratulations", "birthday", "bday", "celebrat\\w*", "🎉", "🥳"], ["🎉", "🍾", "🏆"]),
+    "hype": (["pump", "moon", "bull(?:ish)?", "lfg", "fire", "op", "cool", "nice", "great", "awesome", "🔥", "💯"], ["🔥", "⚡", "💯", "👍"]),
+    "banana": (["banana", "kela", "🍌"], ["🍌"]),
+    "question": (["why", "how", "what", "kya", "kaise", "kyu+n?", "kab", "kaun", "\\?"], ["🤔", "🤓"]),
+}
 
 WM_STYLES = {
     "Normal": "normal", "Bold": "bold", "Italic": "italic", "Bold Italic": "bolditalic",
@@ -165,7 +312,85 @@ FONT_PATHS = {
     "block": ["/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"],
 }
 
+# ── Lazy heavy imports ───────────────────────────────────────────────────────
+# pandas/numpy/matplotlib/mplfinance/ccxt/feedparser/qrcode/cv2/PIL/textblob
+# together take seconds to import, which used to sit in front of start_http()
+# binding the port. They now load on first use by their handler (or from the
+# background warm-up once polling is up), and each first-import is timed.
+LAZY_MODULES = ("numpy", "pandas", "matplotlib", "mplfinance", "ccxt.async_support", "feedparser",
+                "qrcode", "cv2", "PIL.Image", "PIL.ImageDraw", "PIL.ImageFont", "textblob")
+_LAZY_DEPS = {"mplfinance": ("matplotlib",)}  # Agg must be selected before pyplot is pulled in
+WARM_IMPORTS = os.environ.get("WARM_IMPORTS", "1") == "1"
+_lazy_modules: dict = {}
+startup_timing = {"eager_imports_ms": _EAGER_IMPORTS_MS, "lazy_imports_ms": {}, "port_bound_ms": None,
+                  "polling_ms": None, "first_update_ms": None, "warmup_ms": None}
+
+def _since_start_ms() -> float:
+    return round((time.perf_counter() - _PROCESS_T0) * 1000, 1)
+
+def lazy_import(name: str):
+    """Import a heavy module on first use and cache it. The timing recorded is
+    the first-import cost, including any of its deps not already loaded."""
+    mod = _lazy_modules.get(name)
+    if mod is not None:
+        return mod
+    for dep in _LAZY_DEPS.get(name, ()):
+        lazy_import(dep)
+    start = time.perf_counter()
+    mod = importlib.import_module(name)
+    if name == "matplotlib":
+        mod.use("Agg")
+    startup_timing["lazy_imports_ms"][name] = round((time.perf_counter() - start) * 1000, 1)
+    _lazy_modules[name] = mod
+    return mod
+
+async def lazy_import_async(name: str):
+    """lazy_import() run in a worker thread, so a cold first use doesn't stall the event loop."""
+    mod = _lazy_modules.get(name)
+    if mod is not None:
+        return mod
+    return await asyncio.get_running_loop().run_in_executor(None, lazy_import, name)
+
+_lazy_import_failed: set = set()
+
+def lazy_module_or_load(name: str):
+    """
+    Non-blocking variant for hot paths: the module if it's already imported,
+    else None after kicking a background import (shared with any other caller).
+    A module that failed to import isn't retried.
+    """
+    mod = _lazy_modules.get(name)
+    if mod is None and name not in _lazy_import_failed:
+        async def _load():
+            try:
+                await lazy_import_async(name)
+            except Exception as e:
+                _lazy_import_failed.add(name)
+                logger.warning(f"[lazy] {name}: {e}")
+        spawn_background(single_flight(sf_key("import", name), _load))
+    return mod
+
+async def warm_heavy_imports():
+    """Background warm-up after polling starts: pre-import every lazy module, one at a time."""
+    start = time.perf_counter()
+    for name in LAZY_MODULES:
+        try:
+            await lazy_import_async(name)
+        except Exception as e:
+            logger.warning(f"[warmup] {name}: {e}")
+        await asyncio.sleep(0.1)
+    startup_timing["warmup_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    slowest = sorted(startup_timing["lazy_imports_ms"].items(), key=lambda kv: -kv[1])[:5]
+    logger.info(f"[startup] warm-up done in {startup_timing['warmup_ms']}ms — slowest: " + ", ".join(f"{n} {ms}ms" for n, ms in slowest))
+
+async def _note_first_update(u: Update, c: ContextTypes.DEFAULT_TYPE):
+    if startup_timing["first_update_ms"] is None:
+        startup_timing["first_update_ms"] = _since_start_ms()
+        logger.info(f"[startup] eager imports {startup_timing['eager_imports_ms']}ms · port bound {startup_timing['port_bound_ms']}ms · "
+                    f"polling {startup_timing['polling_ms']}ms · first update {startup_timing['first_update_ms']}ms")
+
 def load_font(style_key: str, size: int):
+    ImageFont = lazy_import("PIL.ImageFont")
     for p in FONT_PATHS.get(style_key, FONT_PATHS["normal"]):
         try:
             return ImageFont.truetype(p, size)
@@ -173,9 +398,21 @@ def load_font(style_key: str, size: int):
             continue
     return ImageFont.load_default()
 
-def get_exchange(prefer: str = "bybit"):
+EXCHANGE_HTTP_TIMEOUT_MS = 12000  # ccxt's own per-request timeout
+# Outer asyncio limit per call, never below ccxt's own timeout (plus rate-limiter
+# slack) so ccxt gets to raise its own RequestTimeout first. The full-market
+# fetch_tickers response is much larger and gets more room.
+EXCHANGE_CALL_TIMEOUT = max(float(os.environ.get("EXCHANGE_CALL_TIMEOUT", "15")), EXCHANGE_HTTP_TIMEOUT_MS / 1000 + 2)
+EXCHANGE_METHOD_TIMEOUTS = {"fetch_tickers": 20.0}
+EXCHANGE_POOL_LIMIT = int(os.environ.get("EXCHANGE_POOL_LIMIT", "20"))
+
+_exchange_session: Optional[aiohttp.ClientSession] = None
+exchange_stats = {"calls": 0, "timeouts": 0, "errors": 0, "total_ms": 0, "name": None}
+
+async def get_exchange(prefer: str = "bybit"):
     """
-    Synchronous, blocking network call (ccxt.load_markets()).
+    Connect to the first reachable exchange using ccxt's asyncio client on a
+    shared keep-alive aiohttp session (load_markets() is a network call).
     NEVER call this at module import time — it must only run inside the
     event loop via init_exchange_async() so it can't delay HTTP port
     binding or the Telegram polling startup. Render kills deploys that
@@ -183,144 +420,769 @@ def get_exchange(prefer: str = "bybit"):
     early' here: get_exchange() used to run at import time and blocked
     everything else from starting.
     """
+    global _exchange_session
+    ccxt = await lazy_import_async("ccxt.async_support")
+    if _exchange_session is None or _exchange_session.closed:
+        connector = aiohttp.TCPConnector(limit=EXCHANGE_POOL_LIMIT, ttl_dns_cache=300)
+        _exchange_session = aiohttp.ClientSession(connector=connector)
     exchanges = ["bybit", "okx", "bitget", "kraken", "binance"]
     if prefer in exchanges:
         exchanges.remove(prefer)
         exchanges.insert(0, prefer)
     for ex_name in exchanges:
+        ex = None
         try:
             ex_cls = getattr(ccxt, ex_name)
-            ex = ex_cls({'enableRateLimit': True, 'timeout': 12000})
-            ex.load_markets()
+            ex = ex_cls({'enableRateLimit': True, 'timeout': EXCHANGE_HTTP_TIMEOUT_MS, 'session': _exchange_session})
+            await asyncio.wait_for(ex.load_markets(), timeout=30)
             logger.info(f"Exchange connected: {ex_name}")
+            exchange_stats["name"] = ex_name
             return ex
         except Exception as e:
             logger.warning(f"{ex_name} failed: {str(e)[:60]}")
+            if ex is not None:
+                try:
+                    await ex.close()
+                except Exception:
+                    pass
     logger.error("No exchange available")
     return None
 
 exchange = None
 
 async def init_exchange_async():
-    """Run the blocking exchange connection in a thread so it never blocks the event loop."""
+    """Connect the async exchange client in the background so it never delays startup."""
     global exchange
-    loop = asyncio.get_running_loop()
-    exchange = await loop.run_in_executor(None, get_exchange)
+    exchange = await get_exchange()
 
-async def load_persistent_data():
-    """Runs once at startup. Leaderboard, weekly winners, and stickers all load from MongoDB."""
-    global sticker_data
-    if mongo_leaderboard_col is not None:
-        try:
-            db["scores"] = {}
-            async for doc in mongo_leaderboard_col.find({}):
-                db["scores"][doc["_id"]] = doc.get("users", {})
-            logger.info(f"[mongo] Leaderboard loaded ({len(db['scores'])} chats)")
-        except Exception as e:
-            logger.error(f"[mongo] Leaderboard load failed: {e}")
-            db["scores"] = {}
-    else:
-        db["scores"] = {}
-        logger.warning("[mongo] MONGO_URL not set — leaderboard will not persist.")
+async def exchange_call(method: str, *args, **kwargs):
+    """Call an async ccxt method on the shared exchange with its per-method timeout."""
+    exchange_stats["calls"] += 1
+    start = time.monotonic()
+    try:
+        timeout = max(EXCHANGE_CALL_TIMEOUT, EXCHANGE_METHOD_TIMEOUTS.get(method, 0))
+        return await asyncio.wait_for(getattr(exchange, method)(*args, **kwargs), timeout=timeout)
+    except asyncio.TimeoutError:
+        exchange_stats["timeouts"] += 1
+        raise
+    except Exception:
+        exchange_stats["errors"] += 1
+        raise
+    finally:
+        exchange_stats["total_ms"] += int((time.monotonic() - start) * 1000)
+
+TICKER_REFRESH_SECS = float(os.environ.get("TICKER_REFRESH_SECS", "20"))
 
-    if mongo_weekly_col is not None:
+# Full ticker snapshot, kept fresh by ticker_snapshot_refresher(). Price
+# commands read it directly: "data" maps base symbol (BTC) -> ccxt ticker dict
+# for USDT pairs, "cols" holds every spot pair as NumPy columns for ranking.
+ticker_snapshot = {"ts": 0.0, "data": {}, "cols": None}
+SCREENER_KINDS = {"gainers": "pct", "losers": "pct", "volume": "vol", "volatility": "range"}
+ticker_snapshot_stats = {"refreshes": 0, "failures": 0, "last_ms": 0, "served": 0, "live_fallbacks": 0, "swr_kicks": 0}
+
+def _build_ticker_columns(tickers: dict, np) -> dict:
+    """
+    One pass over the raw tickers into columnar arrays (symbol, quote, last,
+    pct change, quote volume, high/low range %). Runs once per refresh so the
+    ranking commands never loop over tickers in Python. Missing numbers are NaN.
+    """
+    rows = [(sym.split("/", 1), t) for sym, t in tickers.items() if "/" in sym and ":" not in sym]
+    def col(key):
+        return np.array([t.get(key) for _, t in rows], dtype=float)
+    last, high, low = col("last"), col("high"), col("low")
+    vol = col("quoteVolume")
+    vol = np.where(np.isfinite(vol), vol, col("baseVolume") * last)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rng = np.where(low > 0, (high - low) / low * 100.0, np.nan)
+    return {"sym": np.array([b for (b, _), _ in rows]), "quote": np.array([q for (_, q), _ in rows]),
+            "last": last, "pct": col("percentage"), "vol": vol, "range": rng}
+
+def rank_tickers(cols: dict, key: str, k: int, quote: str = "USDT", largest: bool = True):
+    """
+    Indices of the top/bottom k rows by `key` among pairs quoted in `quote`,
+    best first. argpartition picks the k candidates in O(n); only those k are sorted.
+    """
+    np = lazy_import("numpy")
+    values = cols[key]
+    idx = np.flatnonzero((cols["quote"] == quote) & np.isfinite(values) & np.isfinite(cols["last"]))
+    if idx.size == 0:
+        return idx
+    v = values[idx] if largest else -values[idx]
+    k = min(k, idx.size)
+    part = np.argpartition(-v, k - 1)[:k]
+    return idx[part[np.argsort(-v[part], kind="stable")]]
+
+async def refresh_ticker_snapshot():
+    """Fetch every ticker once and swap in the new snapshot. Concurrent callers share one fetch."""
+    async def _fetch():
+        start = time.monotonic()
+        tickers = await exchange_call("fetch_tickers")
+        np = await lazy_import_async("numpy")
+        ticker_snapshot["cols"] = _build_ticker_columns(tickers, np)
+        ticker_snapshot["data"] = {sym.split("/")[0]: t for sym, t in tickers.items() if sym.endswith("/USDT")}
+        ticker_snapshot["ts"] = time.time()
+        ticker_snapshot_stats["refreshes"] += 1
+        ticker_snapshot_stats["last_ms"] = int((time.monotonic() - start) * 1000)
+    try:
+        await single_flight(sf_key("tickers"), _fetch)
+    except Exception as e:
+        ticker_snapshot_stats["failures"] += 1
+        logger.warning(f"[tickers] snapshot refresh failed: {str(e)[:80]}")
+
+async def ticker_snapshot_refresher():
+    """Background loop keeping ticker_snapshot at most TICKER_REFRESH_SECS old."""
+    while True:
+        if exchange is not None:
+            await refresh_ticker_snapshot()
+        await asyncio.sleep(TICKER_REFRESH_SECS)
+
+async def get_ticker_snapshot() -> dict:
+    """
+    Stale-while-revalidate read: answer from the snapshot whatever its age;
+    if it has fallen well behind (refresher stalled), kick a refresh in the
+    background. Only a cold start with no snapshot at all waits for a fetch.
+    """
+    if not ticker_snapshot["ts"]:
+        await refresh_ticker_snapshot()
+    elif time.time() - ticker_snapshot["ts"] > 3 * TICKER_REFRESH_SECS and sf_key("tickers") not in _inflight:
+        ticker_snapshot_stats["swr_kicks"] += 1
+        spawn_background(refresh_ticker_snapshot())
+    ticker_snapshot_stats["served"] += 1
+    return ticker_snapshot
+
+def _snapshot_age_text(ts: float) -> str:
+    age = max(0, int(time.time() - ts))
+    return f"🕒 _updated {age}s ago_" if age < 120 else f"🕒 _updated {age // 60}m ago_"
+
+async def close_exchange():
+    """Close the ccxt client and the shared session it runs on (shutdown)."""
+    global exchange, _exchange_session
+    if exchange is not None:
         try:
-            db["weekly"] = {}
-            async for doc in mongo_weekly_col.find({}):
-                db["weekly"][doc["_id"]] = doc.get("data", {})
+            await exchange.close()
         except Exception as e:
-            logger.error(f"[mongo] Weekly winners load failed: {e}")
-            db["weekly"] = {}
+            logger.warning(f"[exchange] close failed: {e}")
+        exchange = None
+    if _exchange_session is not None and not _exchange_session.closed:
+        await _exchange_session.close()
+    _exchange_session = None
+
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "mongo" if MONGO_URL else "sqlite").strip().lower()
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "beluga.db")
+
+# ── Storage backends ─────────────────────────────────────────────────────────
+# Everything persistent (scores, weekly winners, sticker packs, chat memory)
+# goes through the `storage` op table below, so the sync_*/flush_*/memory
+# functions don't care whether MongoDB or the embedded SQLite file is behind
+# them. Each backend is a dict of coroutines with the same keys.
+
+async def _mongo_init():
+    await mongo_scores_col.create_index([("chat", 1), ("score", -1)], name="chat_score_desc")
+    await migrate_leaderboard_layout()
+
+async def _mongo_score_get(cid: str, uid: str):
+    return await mongo_scores_col.find_one({"_id": f"{cid}:{uid}"}, {"_id": 0, "name": 1, "user_id": 1, "score": 1})
+
+async def _mongo_scores_chat(cid: str) -> list:
+    cursor = mongo_scores_col.find({"chat": cid}, {"_id": 0, "uid": 1, "name": 1, "user_id": 1, "score": 1}).sort("score", -1)
+    return [doc async for doc in cursor]
+
+async def _mongo_scores_apply(batch: dict):
+    await mongo_scores_col.bulk_write([
+        UpdateOne(
+            {"_id": f"{cid}:{uid}"},
+            {"$inc": {"score": d["delta"]},
+             "$set": {"name": d["name"], "user_id": d["user_id"]},
+             "$setOnInsert": {"chat": cid, "uid": uid}},
+            upsert=True,
+        )
+        for (cid, uid), d in batch.items()
+    ], ordered=False)
+
+async def _mongo_scores_reset(cid: str):
+    await mongo_scores_col.delete_many({"chat": cid})
+
+async def _mongo_weekly_get(cid: str):
+    doc = await mongo_weekly_col.find_one({"_id": cid})
+    return doc.get("data", {}) if doc else None
+
+async def _mongo_weekly_put(cid: str, data: dict):
+    await mongo_weekly_col.replace_one({"_id": cid}, {"_id": cid, "data": data}, upsert=True)
+
+async def _mongo_stickers_all() -> tuple:
+    packs, banned = {}, []
+    async for doc in mongo_stickers_col.find({}):
+        if doc["_id"] == "_banned_packs":
+            banned = doc.get("banned_packs", [])
+        else:
+            packs[doc["_id"]] = doc.get("file_ids", [])
+    return packs, banned
+
+async def _mongo_sticker_pack_put(pack_name: str, file_ids: list):
+    await mongo_stickers_col.replace_one({"_id": pack_name}, {"_id": pack_name, "file_ids": file_ids}, upsert=True)
+
+async def _mongo_banned_packs_put(banned: list):
+    await mongo_stickers_col.replace_one({"_id": "_banned_packs"}, {"_id": "_banned_packs", "banned_packs": banned}, upsert=True)
+
+async def _mongo_memory_get(key: str):
+    return await mongo_memory_col.find_one({"_id": key})
+
+async def _mongo_memory_put_many(batch: dict):
+    await mongo_memory_col.bulk_write([ReplaceOne({"_id": k}, doc, upsert=True) for k, doc in batch.items()], ordered=False)
+
+async def _mongo_memory_delete(key: str):
+    await mongo_memory_col.delete_one({"_id": key})
+
+async def _mongo_memory_clear() -> int:
+    return (await mongo_memory_col.delete_many({})).deleted_count
+
+async def _mongo_close():
+    mongo_client.close()
+
+# SQLite runs on one dedicated thread: every statement is serialised there,
+# off the event loop, and each batch is a single transaction. WAL keeps
+# readers from blocking on the writer.
+_sqlite_conn = None
+_sqlite_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scores (chat TEXT NOT NULL, uid TEXT NOT NULL, name TEXT, user_id INTEGER, score INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (chat, uid));
+CREATE INDEX IF NOT EXISTS scores_chat_score_desc ON scores (chat, score DESC);
+CREATE TABLE IF NOT EXISTS weekly_winners (chat TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS stickers (id TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS chat_memory (id TEXT PRIMARY KEY, doc TEXT NOT NULL);
+"""
+
+def _sqlite_open():
+    global _sqlite_conn
+    conn = sqlite3.connect(SQLITE_PATH, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(_SQLITE_SCHEMA)
+    _sqlite_conn = conn
+
+def _sqlite_tx(statements: list):
+    """Run [(sql, params_or_rows, many)] in one transaction."""
+    cur = _sqlite_conn.cursor()
+    cur.execute("BEGIN")
+    try:
+        total = 0
+        for sql, params, many in statements:
+            (cur.executemany if many else cur.execute)(sql, params)
+            total += cur.rowcount
+        cur.execute("COMMIT")
+        return total
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+
+def _sqlite_query(sql: str, params: tuple) -> list:
+    return _sqlite_conn.execute(sql, params).fetchall()
+
+async def _sqlite_run(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_sqlite_executor, fn, *args)
+
+async def _sqlite_write(*statements):
+    return await _sqlite_run(_sqlite_tx, list(statements))
+
+async def _sqlite_init():
+    await _sqlite_run(_sqlite_open)
+    logger.info(f"[sqlite] Storage at {SQLITE_PATH} (WAL)")
+
+async def _sqlite_score_get(cid: str, uid: str):
+    rows = await _sqlite_run(_sqlite_query, "SELECT name, user_id, score FROM scores WHERE chat = ? AND uid = ?", (cid, uid))
+    return {"name": rows[0][0], "user_id": rows[0][1], "score": rows[0][2]} if rows else None
+
+async def _sqlite_scores_chat(cid: str) -> list:
+    rows = await _sqlite_run(_sqlite_query, "SELECT uid, name, user_id, score FROM scores WHERE chat = ? ORDER BY score DESC", (cid,))
+    return [{"uid": uid, "name": name, "user_id": user_id, "score": score} for uid, name, user_id, score in rows]
+
+async def _sqlite_scores_apply(batch: dict):
+    await _sqlite_write((
+        "INSERT INTO scores (chat, uid, name, user_id, score) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT (chat, uid) DO UPDATE SET score = score + excluded.score, name = excluded.name, user_id = excluded.user_id",
+        [(cid, uid, d["name"], d["user_id"], d["delta"]) for (cid, uid), d in batch.items()], True,
+    ))
+
+async def _sqlite_scores_reset(cid: str):
+    await _sqlite_write(("DELETE FROM scores WHERE chat = ?", (cid,), False))
+
+async def _sqlite_weekly_get(cid: str):
+    rows = await _sqlite_run(_sqlite_query, "SELECT data FROM weekly_winners WHERE chat = ?", (cid,))
+    return json.loads(rows[0][0]) if rows else None
+
+async def _sqlite_weekly_put(cid: str, data: dict):
+    await _sqlite_write(("INSERT OR REPLACE INTO weekly_winners (chat, data) VALUES (?, ?)", (cid, json.dumps(data)), False))
+
+async def _sqlite_stickers_all() -> tuple:
+    rows = await _sqlite_run(_sqlite_query, "SELECT id, data FROM stickers", ())
+    packs = {k: json.loads(v) for k, v in rows}
+    return packs, packs.pop("_banned_packs", [])
+
+async def _sqlite_sticker_pack_put(pack_name: str, file_ids: list):
+    await _sqlite_write(("INSERT OR REPLACE INTO stickers (id, data) VALUES (?, ?)", (pack_name, json.dumps(file_ids)), False))
+
+async def _sqlite_banned_packs_put(banned: list):
+    await _sqlite_write(("INSERT OR REPLACE INTO stickers (id, data) VALUES ('_banned_packs', ?)", (json.dumps(banned),), False))
+
+async def _sqlite_memory_get(key: str):
+    rows = await _sqlite_run(_sqlite_query, "SELECT doc FROM chat_memory WHERE id = ?", (key,))
+    return json.loads(rows[0][0]) if rows else None
+
+async def _sqlite_memory_put_many(batch: dict):
+    await _sqlite_write(("INSERT OR REPLACE INTO chat_memory (id, doc) VALUES (?, ?)",
+                         [(k, json.dumps(doc)) for k, doc in batch.items()], True))
+
+async def _sqlite_memory_delete(key: str):
+    await _sqlite_write(("DELETE FROM chat_memory WHERE id = ?", (key,), False))
+
+async def _sqlite_memory_clear() -> int:
+    return await _sqlite_write(("DELETE FROM chat_memory", (), False))
+
+async def _sqlite_close():
+    if _sqlite_conn is not None:
+        await _sqlite_run(_sqlite_conn.close)
+    _sqlite_executor.shutdown(wait=False)
+
+_STORAGE_OPS = ("init", "close", "score_get", "scores_chat", "scores_apply", "scores_reset", "weekly_get", "weekly_put",
+                "stickers_all", "sticker_pack_put", "banned_packs_put", "memory_get", "memory_put_many", "memory_delete", "memory_clear")
+STORAGE_BACKENDS = {name: {op: globals()[f"_{name}_{op}"] for op in _STORAGE_OPS} for name in ("mongo", "sqlite")}
+
+if STORAGE_BACKEND == "mongo" and mongo_db is None:
+    logger.warning("[storage] STORAGE_BACKEND=mongo but MONGO_URL not set — falling back to sqlite.")
+    STORAGE_BACKEND = "sqlite"
+storage = STORAGE_BACKENDS.get(STORAGE_BACKEND)  # None (e.g. STORAGE_BACKEND=none) disables persistence
+storage_stats = {"ops": 0, "errors": 0, "total_ms": 0, "max_ms": 0}
+
+async def storage_call(op: str, *args):
+    """Run one storage op on the active backend, timing it for /health. Errors propagate to the caller."""
+    start = time.monotonic()
+    try:
+        return await storage[op](*args)
+    except Exception:
+        storage_stats["errors"] += 1
+        raise
+    finally:
+        took = int((time.monotonic() - start) * 1000)
+        storage_stats["ops"] += 1
+        storage_stats["total_ms"] += took
+        storage_stats["max_ms"] = max(storage_stats["max_ms"], took)
+
+def storage_summary() -> dict:
+    st = storage_stats
+    return {"backend": STORAGE_BACKEND if storage is not None else "none", **st,
+            "avg_ms": round(st["total_ms"] / st["ops"], 2) if st["ops"] else 0.0}
+
+async def close_storage():
+    if storage is None:
+        return
+    try:
+        await storage["close"]()
+    except Exception as e:
+        logger.error(f"[storage] close failed: {e}")
+
+async def load_persistent_data():
+    """Runs once at startup. Only the (small) sticker collection is read here;
+    scores load per user on first bump (see _score_entry), a chat's rank index
+    when /lb first asks (see chat_state), weekly winners per chat (see get_weekly)."""
+    global sticker_data
+    sticker_data = {"packs": {}, "banned_packs": []}
+    if storage is None:
+        logger.warning("[storage] No storage backend — leaderboard, stickers and memory will not persist.")
+        return
+    try:
+        await storage_call("init")
+    except Exception as e:
+        logger.error(f"[storage] {STORAGE_BACKEND} init failed: {e}")
+
+    try:
+        packs, banned = await storage_call("stickers_all")
+        sticker_data["packs"] = packs
+        sticker_data["banned_packs"] = banned
+        rebuild_sticker_index()
+        logger.info(f"[storage] Stickers loaded ({len(packs)} packs, {len(banned)} banned)")
+    except Exception as e:
+        logger.error(f"[storage] Sticker load failed: {e}")
+
+LB_FLUSH_SECS = int(os.environ.get("LB_FLUSH_SECS", "10"))
+LB_CACHE_MAX = int(os.environ.get("LB_CACHE_MAX", "20000"))
+
+# (cid, uid) -> {"name", "user_id", "score"}; LRU over per-user score docs. Only
+# clean entries are evicted (after a flush), so a miss always means storage is current.
+score_cache: OrderedDict = OrderedDict()
+score_cache_stats = {"hits": 0, "misses": 0, "loads": 0, "load_failures": 0, "evictions": 0}
+_score_resets: dict = {}  # cid -> reset generation, so a load racing /nw's reset is discarded
+
+# cid -> {"scores": {uid: entry}, "rank": [(-score, uid), ...] kept sorted}.
+# LRU over the chats /lb has looked at, capped by total entries. A chat is
+# loaded whole (in index order) only when /lb or a rank lookup needs it, then
+# kept current by every bump. Without a storage backend each chat is indexed
+# from its first bump and never evicted.
+chat_cache: OrderedDict = OrderedDict()
+chat_cache_stats = {"hits": 0, "misses": 0, "hydrations": 0, "hydrate_ms_total": 0, "evictions": 0, "top_queries": 0}
+_chat_loading: dict = {}  # cid -> uids bumped while that chat's index was loading
+
+# cid -> last week's {"top3", "week_label"}, loaded only for /lb.
+weekly_cache = BoundedDict("weekly", ttl=3600, max_items=int(os.environ.get("WEEKLY_CACHE_MAX", "2000")))
+
+_lb_dirty: dict = {}  # (cid, uid) -> {"delta": int, "name": str, "user_id": int}
+_lb_flush_lock = asyncio.Lock()  # keeps a chat reset from interleaving with an in-flight $inc batch
+lb_flush_stats = {"flushes": 0, "ops": 0, "bumps_coalesced": 0, "failures": 0, "last_flush_ms": 0}
+
+def mark_score_dirty(cid: str, uid: str, delta: int, name: str, user_id: int):
+    """Record an applied score change for the next write-behind flush; repeat bumps merge into one $inc."""
+    entry = _lb_dirty.get((cid, uid))
+    if entry is None:
+        _lb_dirty[(cid, uid)] = {"delta": delta, "name": name, "user_id": user_id}
     else:
-        db["weekly"] = {}
+        entry["delta"] += delta
+        entry["name"] = name
+        lb_flush_stats["bumps_coalesced"] += 1
 
-    if mongo_stickers_col is not None:
+async def flush_leaderboard():
+    """
+    Write every dirty (chat, user) delta as one batch of per-user increments
+    (an unordered bulk_write on Mongo, one transaction on SQLite). Failed
+    batches are merged back into the dirty set so nothing is lost before the
+    next attempt.
+    """
+    if storage is None:
+        _lb_dirty.clear()
+        return
+    async with _lb_flush_lock:
+        if not _lb_dirty:
+            _trim_score_cache()
+            return
+        # Snapshot under the lock: a reset_chat_scores() between copy and write
+        # would otherwise be overwritten by this batch's stale increments.
+        batch = dict(_lb_dirty)
+        _lb_dirty.clear()
+        start = time.monotonic()
         try:
-            packs, banned = {}, []
-            async for doc in mongo_stickers_col.find({}):
-                if doc["_id"] == "_banned_packs":
-                    banned = doc.get("banned_packs", [])
-                else:
-                    packs[doc["_id"]] = doc.get("file_ids", [])
-            sticker_data["packs"] = packs
-            sticker_data["banned_packs"] = banned
-            logger.info(f"[mongo] Stickers loaded ({len(packs)} packs, {len(banned)} banned)")
+            await storage_call("scores_apply", batch)
         except Exception as e:
-            logger.error(f"[mongo] Sticker load failed: {e}")
-            sticker_data = {"packs": {}, "banned_packs": []}
-    else:
-        sticker_data = {"packs": {}, "banned_packs": []}
-        logger.warning("[mongo] MONGO_URL not set — stickers will not persist.")
-
-async def sync_leaderboard_chat_to_mongo(cid: str):
-    """Push one chat's current scores dict to MongoDB immediately."""
-    if mongo_leaderboard_col is None:
+            lb_flush_stats["failures"] += 1
+            logger.error(f"[storage] flush_leaderboard ({len(batch)} ops) failed: {e}")
+            for key, d in batch.items():
+                if key in _lb_dirty:
+                    _lb_dirty[key]["delta"] += d["delta"]
+                else:
+                    _lb_dirty[key] = d
+            return
+        lb_flush_stats["flushes"] += 1
+        lb_flush_stats["ops"] += len(batch)
+        lb_flush_stats["last_flush_ms"] = int((time.monotonic() - start) * 1000)
+        _trim_score_cache()
+
+def _trim_score_cache():
+    """Evict least-recently-used clean entries down to LB_CACHE_MAX. Without a
+    storage backend the cache is the only copy of the scores, so nothing is evicted."""
+    if storage is None:
+        return
+    excess = len(score_cache) - LB_CACHE_MAX
+    if excess <= 0:
         return
+    for key in list(score_cache):
+        if excess <= 0:
+            break
+        if key in _lb_dirty:
+            continue
+        del score_cache[key]
+        score_cache_stats["evictions"] += 1
+        excess -= 1
+
+def _trim_chat_cache():
+    """Evict least-recently-used chat indexes until their entries fit
+    LB_CACHE_MAX. Any chat can go: a reload overlays pending bumps from
+    score_cache. Without a storage backend nothing is evicted."""
+    if storage is None:
+        return
+    excess = sum(len(st["scores"]) for st in chat_cache.values()) - LB_CACHE_MAX
+    for cid in list(chat_cache):
+        if excess <= 0 or len(chat_cache) <= 1:
+            break
+        excess -= len(chat_cache.pop(cid)["scores"])
+        chat_cache_stats["evictions"] += 1
+
+async def _score_entry(cid: str, uid: str, name: str) -> dict:
+    """
+    Cached score entry for (chat, user), loading that one row on a miss.
+    Concurrent misses share one load. A failed load raises (and caches
+    nothing), so callers never apply a delta to a score counted from zero.
+    """
+    key = (cid, uid)
+    e = score_cache.get(key)
+    if e is not None:
+        score_cache_stats["hits"] += 1
+        score_cache.move_to_end(key)
+        return e
+    score_cache_stats["misses"] += 1
+    doc = None
+    if storage is not None:
+        gen = _score_resets.get(cid, 0)
+        try:
+            doc = await single_flight(f"score:{cid}:{uid}", lambda: storage_call("score_get", cid, uid))
+        except Exception as ex:
+            score_cache_stats["load_failures"] += 1
+            logger.error(f"[storage] score load {cid}:{uid} failed: {ex}")
+            raise
+        score_cache_stats["loads"] += 1
+        if _score_resets.get(cid, 0) != gen:
+            doc = None  # the chat was reset while we were loading
+    e = score_cache.get(key)  # a concurrent bump may have cached it meanwhile
+    if e is None:
+        e = {"name": name, "user_id": int(uid) if uid.lstrip("-").isdigit() else 0, "score": 0}
+        if doc:
+            e["score"] = doc.get("score", 0)
+            e["user_id"] = doc.get("user_id", e["user_id"])
+        score_cache[key] = e
+    return e
+
+async def _hydrate_chat(cid: str) -> dict:
+    """Load one chat's scores (in index order) into a rank index and install
+    it in chat_cache. Live score_cache entries win over stored rows, and users
+    bumped while the load was in flight (or still awaiting a flush) are
+    overlaid. Raises on failure."""
+    start = time.monotonic()
+    gen = _score_resets.get(cid, 0)
+    _chat_loading[cid] = set()
     try:
-        await mongo_leaderboard_col.replace_one(
-            {"_id": cid}, {"_id": cid, "users": db.get("scores", {}).get(cid, {})}, upsert=True
-        )
+        rows = await storage_call("scores_chat", cid)
+    finally:
+        bumped = _chat_loading.pop(cid, set())
+    if _score_resets.get(cid, 0) != gen:
+        rows = []  # reset mid-load; only bumps made after it count
+    scores = {}
+    for r in rows:
+        live = score_cache.get((cid, r["uid"]))
+        scores[r["uid"]] = live if live is not None else {"name": r.get("name", "?"), "user_id": r.get("user_id", 0), "score": r.get("score", 0)}
+    for uid in bumped | {u for c, u in _lb_dirty if c == cid}:
+        live = score_cache.get((cid, uid))
+        if live is not None:
+            scores[uid] = live
+    chat_cache_stats["hydrations"] += 1
+    chat_cache_stats["hydrate_ms_total"] += int((time.monotonic() - start) * 1000)
+    # Installed here, not by the caller, so no bump can land between the load
+    # finishing and the index becoming visible to _rank_note().
+    st = chat_cache[cid] = {"scores": scores, "rank": sorted((-e["score"], uid) for uid, e in scores.items())}
+    _trim_chat_cache()
+    return st
+
+async def chat_state(cid: str) -> dict:
+    """A chat's rank index, loading it on first use. Concurrent first uses
+    share one load; a failed load raises and isn't cached."""
+    st = chat_cache.get(cid)
+    if st is not None:
+        chat_cache_stats["hits"] += 1
+        chat_cache.move_to_end(cid)
+        return st
+    chat_cache_stats["misses"] += 1
+    if storage is None:
+        return {"scores": {}, "rank": []}  # nothing bumped in this chat yet
+    try:
+        loaded = await single_flight(f"chat:{cid}", lambda: _hydrate_chat(cid))
     except Exception as e:
-        logger.error(f"[mongo] sync_leaderboard_chat_to_mongo({cid}) failed: {e}")
+        logger.error(f"[storage] hydrate chat {cid} failed: {e}")
+        raise
+    return chat_cache.get(cid, loaded)
+
+def _rank_note(cid: str, uid: str, old: int, e: dict):
+    """Apply a bump to the chat's rank index if it is loaded (`old` is the
+    entry's score before the bump). Unloaded chats are left alone, except that
+    a load in flight remembers the user so it can overlay them."""
+    st = chat_cache.get(cid)
+    if st is None:
+        if storage is not None:
+            if cid in _chat_loading:
+                _chat_loading[cid].add(uid)
+            return
+        st = chat_cache[cid] = {"scores": {}, "rank": []}
+    prev = st["scores"].get(uid)
+    prev_score = None if prev is None else (old if prev is e else prev["score"])
+    st["scores"][uid] = e
+    if e["score"] != prev_score:
+        _rank_move(st, uid, prev_score, e["score"])
+
+async def get_weekly(cid: str) -> dict:
+    """Last week's champions for a chat, loaded on first ask. A failed load
+    shows nothing and isn't cached, so the next /lb retries."""
+    data = weekly_cache.get(cid)
+    if data is not None:
+        return data
+    if storage is None:
+        return {}
+    try:
+        data = await single_flight(f"weekly:{cid}", lambda: storage_call("weekly_get", cid)) or {}
+    except Exception as e:
+        logger.error(f"[storage] weekly load {cid} failed: {e}")
+        return {}
+    weekly_cache[cid] = data
+    return data
+
+def _rank_move(st: dict, uid: str, old, new: int):
+    """Re-slot a user in the chat's sorted (-score, uid) list; old=None for a new user.
+    Bisect finds both slots in O(log n); the list shift itself is a memmove."""
+    rank = st["rank"]
+    if old is not None:
+        i = bisect_left(rank, (-old, uid))
+        if i < len(rank) and rank[i] == (-old, uid):
+            del rank[i]
+    insort(rank, (-new, uid))
+
+async def top_scores(cid: str, n: int) -> list:
+    """Top-n entries for a chat, highest first, read straight off the rank list."""
+    chat_cache_stats["top_queries"] += 1
+    st = await chat_state(cid)
+    return [st["scores"][uid] for _, uid in st["rank"][:n]]
+
+async def score_rank(cid: str, uid: str):
+    """(1-based rank, entry) for a user in a chat, or (None, None) if they have no score."""
+    st = await chat_state(cid)
+    e = st["scores"].get(uid)
+    if e is None:
+        return None, None
+    return bisect_left(st["rank"], (-e["score"], uid)) + 1, e
+
+async def reset_chat_scores(cid: str):
+    """Delete every score for one chat (used by /nw's reset). Pending
+    write-behind deltas for that chat are dropped under the flush lock so an
+    in-flight batch can't resurrect them."""
+    async with _lb_flush_lock:
+        for key in [k for k in _lb_dirty if k[0] == cid]:
+            del _lb_dirty[key]
+        for key in [k for k in score_cache if k[0] == cid]:
+            del score_cache[key]
+        _score_resets[cid] = _score_resets.get(cid, 0) + 1
+        chat_cache[cid] = {"scores": {}, "rank": []}
+        if storage is None:
+            return
+        try:
+            await storage_call("scores_reset", cid)
+        except Exception as e:
+            logger.error(f"[storage] reset_chat_scores({cid}) failed: {e}")
 
-async def sync_weekly_to_mongo(cid: str):
-    """Push one chat's weekly-winners record to MongoDB immediately."""
-    if mongo_weekly_col is None:
+LB_MIGRATION_MARKER = "_scores_layout_v2"  # legacy-collection doc recording the finished migration
+
+async def migrate_leaderboard_layout():
+    """
+    One-time move from the legacy `leaderboard` collection (one doc per chat
+    holding every user) to per-user `scores` docs. Each legacy doc is marked
+    with migrated_at once copied; $setOnInsert keeps a re-run from clobbering
+    scores that have moved on since. A marker doc is written once the pass
+    completes, so later boots skip the (unindexed) scan entirely.
+    """
+    if mongo_leaderboard_col is None or mongo_scores_col is None:
+        return
+    if await mongo_leaderboard_col.find_one({"_id": LB_MIGRATION_MARKER}, {"_id": 1}):
+        return
+    chats = users = 0
+    async for doc in mongo_leaderboard_col.find({"migrated_at": {"$exists": False}}):
+        cid = doc["_id"]
+        ops = [
+            UpdateOne(
+                {"_id": f"{cid}:{uid}"},
+                {"$setOnInsert": {"chat": cid, "uid": uid, "name": e.get("name", "?"),
+                                  "user_id": e.get("user_id", 0), "score": e.get("score", 0)}},
+                upsert=True,
+            )
+            for uid, e in doc.get("users", {}).items()
+        ]
+        if ops:
+            await mongo_scores_col.bulk_write(ops, ordered=False)
+        await mongo_leaderboard_col.update_one({"_id": cid}, {"$set": {"migrated_at": datetime.now()}})
+        chats += 1
+        users += len(ops)
+    await mongo_leaderboard_col.replace_one({"_id": LB_MIGRATION_MARKER}, {"_id": LB_MIGRATION_MARKER, "migrated_at": datetime.now()}, upsert=True)
+    if chats:
+        logger.info(f"[mongo] Migrated leaderboard layout: {chats} chats, {users} users")
+
+async def sync_weekly_to_mongo(cid: str, data: dict):
+    """Push one chat's weekly-winners record to storage immediately."""
+    if storage is None:
         return
     try:
-        await mongo_weekly_col.replace_one(
-            {"_id": cid}, {"_id": cid, "data": db.get("weekly", {}).get(cid, {})}, upsert=True
-        )
+        await storage_call("weekly_put", cid, data)
     except Exception as e:
-        logger.error(f"[mongo] sync_weekly_to_mongo({cid}) failed: {e}")
+        logger.error(f"[storage] sync_weekly_to_mongo({cid}) failed: {e}")
 
 async def sync_sticker_pack_to_mongo(pack_name: str):
-    """Push one sticker pack's file_ids to MongoDB."""
-    if mongo_stickers_col is None:
+    """Push one sticker pack's file_ids to storage."""
+    if storage is None:
         return
     try:
-        await mongo_stickers_col.replace_one(
-            {"_id": pack_name}, {"_id": pack_name, "file_ids": sticker_data["packs"].get(pack_name, [])}, upsert=True
-        )
+        await storage_call("sticker_pack_put", pack_name, sticker_data["packs"].get(pack_name, []))
     except Exception as e:
-        logger.error(f"[mongo] sync_sticker_pack_to_mongo({pack_name}) failed: {e}")
+        logger.error(f"[storage] sync_sticker_pack_to_mongo({pack_name}) failed: {e}")
 
 async def sync_banned_packs_to_mongo():
-    """Push the banned-packs list to MongoDB."""
-    if mongo_stickers_col is None:
+    """Push the banned-packs list to storage."""
+    if storage is None:
         return
     try:
-        await mongo_stickers_col.replace_one(
-            {"_id": "_banned_packs"}, {"_id": "_banned_packs", "banned_packs": sticker_data["banned_packs"]}, upsert=True
-        )
+        await storage_call("banned_packs_put", sticker_data["banned_packs"])
     except Exception as e:
-        logger.error(f"[mongo] sync_banned_packs_to_mongo failed: {e}")
+        logger.error(f"[storage] sync_banned_packs_to_mongo failed: {e}")
 
 async def save_all_data():
-    """No-op now — all writes (leaderboard, weekly, stickers) sync to MongoDB immediately at the point of change."""
-    pass
+    """Flush pending leaderboard deltas and chat-memory writes. Weekly winners and stickers still sync immediately at the point of change."""
+    await flush_leaderboard()
+    await flush_memory()
 
 async def periodic_sync():
-    """Kept as a no-op background loop for structural compatibility; all data now syncs immediately."""
+    """Write-behind loop: flushes batched leaderboard deltas every LB_FLUSH_SECS."""
     while True:
-        await asyncio.sleep(30)
-
-async def load_sticker_pack(bot, pack_name: str):
-    """Fetch a sticker pack's file_ids from Telegram, store in memory + MongoDB."""
+        await asyncio.sleep(LB_FLUSH_SECS)
+        try:
+            await flush_leaderboard()
+        except Exception as e:
+            logger.error(f"[periodic_sync] {e}")
+
+def rebuild_sticker_index():
+    """Recompute the banned-pack set and the flat pick pool (one slot per
+    sticker, so packs are weighted by size) from sticker_data."""
+    banned = frozenset(sticker_data.get("banned_packs", []))
+    by_pack = {name: tuple(ids) for name, ids in sticker_data.get("packs", {}).items() if name not in banned and ids}
+    sticker_index["banned"] = banned
+    sticker_index["by_pack"] = by_pack
+    sticker_index["pool"] = [fid for ids in by_pack.values() for fid in ids]
+    sticker_stats["rebuilds"] += 1
+
+async def load_sticker_pack(bot, pack_name: str) -> bool:
+    """Fetch a sticker pack's file_ids from Telegram. Memory, the index and
+    storage are only updated when the pack actually changed; returns whether it did."""
     try:
         sticker_set = await bot.get_sticker_set(pack_name)
         file_ids = [s.file_id for s in sticker_set.stickers]
-        sticker_data["packs"][pack_name] = file_ids
-        await sync_sticker_pack_to_mongo(pack_name)
-        logger.info(f"Sticker pack loaded: {pack_name} ({len(file_ids)} stickers)")
+        sticker_stats["packs_fetched"] += 1
     except Exception as e:
+        sticker_stats["fetch_failures"] += 1
         logger.warning(f"Could not load sticker pack '{pack_name}': {e}")
+        return False
+    if sticker_data["packs"].get(pack_name) == file_ids:
+        return False
+    sticker_data["packs"][pack_name] = file_ids
+    rebuild_sticker_index()
+    await sync_sticker_pack_to_mongo(pack_name)
+    sticker_stats["packs_changed"] += 1
+    logger.info(f"Sticker pack loaded: {pack_name} ({len(file_ids)} stickers)")
+    return True
+
+async def sticker_refresher(bot):
+    """Background pack refresh: runs right after startup, then every STICKER_REFRESH_SECS."""
+    while True:
+        try:
+            await asyncio.gather(load_sticker_pack(bot, STICKER_PACK_MAIN), load_sticker_pack(bot, STICKER_PACK_SAFE))
+            sticker_stats["refreshes"] += 1
+        except Exception as e:
+            logger.error(f"[sticker_refresher] {e}")
+        await asyncio.sleep(STICKER_REFRESH_SECS)
 
 async def ban_sticker_pack(pack_name: str):
     """Add a pack to the banned list. Any sticker sent FROM this pack by any
     user in any group will be auto-deleted by the bot (see monitor())."""
-    if pack_name not in sticker_data["banned_packs"]:
+    if pack_name not in sticker_index["banned"]:
         sticker_data["banned_packs"].append(pack_name)
+        rebuild_sticker_index()
         await sync_banned_packs_to_mongo()
         logger.info(f"Sticker pack banned: {pack_name}")
 
@@ -328,21 +1190,16 @@ def is_pack_banned(pack_name: Optional[str]) -> bool:
     """Check whether a sticker's set_name is on the banned list."""
     if not pack_name:
         return False
-    return pack_name in sticker_data.get("banned_packs", [])
+    return pack_name in sticker_index["banned"]
 
 async def get_random_sticker_from(pack_name: str) -> Optional[str]:
     """Get a random sticker file_id from ONE specific pack (skips if banned)."""
-    if is_pack_banned(pack_name):
-        return None
-    stickers = sticker_data.get("packs", {}).get(pack_name, [])
+    stickers = sticker_index["by_pack"].get(pack_name)
     return random.choice(stickers) if stickers else None
 
 async def get_random_sticker_any() -> Optional[str]:
     """Get a random sticker from ANY loaded, non-banned pack."""
-    pool = []
-    for pack_name, stickers in sticker_data.get("packs", {}).items():
-        if pack_name not in sticker_data.get("banned_packs", []):
-            pool.extend(stickers)
+    pool = sticker_index["pool"]
     return random.choice(pool) if pool else None
 
 async def safe_react(bot, chat_id: int, msg_id: int, emoji: str = None):
@@ -358,7 +1215,48 @@ def clean_html(t: str) -> str:
     t = re.sub(r"&[a-zA-Z#0-9]+;", " ", t)
     return re.sub(r"\s+", " ", t).strip()
 
-_resolved_image_cache: dict = {}
+_inflight: dict = {}  # normalised request key -> asyncio.Task shared by every concurrent caller
+single_flight_stats = {"calls": 0, "coalesced": 0, "by_kind": {}}
+
+def sf_key(kind: str, *parts) -> str:
+    """Normalised single-flight key: kind + lower-cased, whitespace-collapsed parts."""
+    return kind + ":" + "|".join(re.sub(r"\s+", " ", str(p)).strip().lower() for p in parts)
+
+async def single_flight(key: str, coro_fn):
+    """
+    Coalesce identical concurrent calls: the first caller starts `coro_fn()`
+    as a task, later callers with the same key await that same task instead
+    of issuing their own request. The task is shielded so one caller being
+    cancelled doesn't cancel the work for the others.
+    """
+    kind = key.split(":", 1)[0]
+    single_flight_stats["calls"] += 1
+    task = _inflight.get(key)
+    if task is not None:
+        single_flight_stats["coalesced"] += 1
+        single_flight_stats["by_kind"][kind] = single_flight_stats["by_kind"].get(kind, 0) + 1
+        return await asyncio.shield(task)
+    task = asyncio.ensure_future(coro_fn())
+    _inflight[key] = task
+    task.add_done_callback(lambda t: _inflight.pop(key, None) if _inflight.get(key) is t else None)
+    return await asyncio.shield(task)
+
+_background_tasks: set = set()
+
+def spawn_background(coro) -> asyncio.Task:
+    """Fire-and-forget create_task() that keeps a reference until the task is
+    done (the event loop itself only holds a weak one)."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def single_flight_executor(key: str, fn, *args):
+    """single_flight() for blocking helpers that normally go through loop.run_in_executor."""
+    loop = asyncio.get_running_loop()
+    return await single_flight(key, lambda: loop.run_in_executor(None, fn, *args))
+
+_resolved_image_cache = BoundedDict("resolved_image_cache", ttl=86400, max_items=2000)
 
 def resolve_postimg_direct_url(page_url: str) -> Optional[str]:
     """
@@ -441,8 +1339,11 @@ def get_user_name(user) -> str:
     return "buddy"
 
 def analyze_sentiment(text: str) -> tuple:
+    textblob = lazy_module_or_load("textblob")
+    if textblob is None:  # still loading: answer neutral rather than import on the event loop
+        return 0.0, random.choice(SENTIMENT_NEUTRAL)
     try:
-        blob = TextBlob(text)
+        blob = textblob.TextBlob(text)
         polarity = blob.sentiment.polarity
         if polarity > 0.3:
             return polarity, random.choice(SENTIMENT_POSITIVE)
@@ -451,186 +1352,1022 @@ def analyze_sentiment(text: str) -> tuple:
         else:
             return polarity, random.choice(SENTIMENT_NEUTRAL)
     except Exception:
-        return 0.0, "🐾"
+        return 0.0, "👀"
+
+def _compile_emoji_lexicon() -> tuple:
+    """
+    Built once at import: plain single words go into a dict for O(1) token
+    lookups; patterns, phrases and emoji go into one alternation with a
+    named group per category.
+    """
+    words, parts = {}, []
+    for cat, (triggers, _) in EMOJI_LEXICON.items():
+        alts = []
+        for t in triggers:
+            if re.fullmatch(r"[a-z]+", t):
+                words.setdefault(t, cat)
+            elif t[0].isalnum():
+                alts.append(rf"\b(?:{t})\b")
+            else:
+                alts.append(t)
+        if alts:
+            parts.append(f"(?P<{cat}>{'|'.join(alts)})")
+    return words, re.compile("|".join(parts), re.IGNORECASE)
 
-def bump_score(cid: str, uid: str, name: str, delta: int) -> int:
-    """Synchronous in-memory score update. Caller is responsible for calling
-    sync_leaderboard_chat_to_mongo(cid) afterward to persist to MongoDB."""
-    db.setdefault("scores", {}).setdefault(cid, {})
-    e = db["scores"][cid].get(uid, {"name": name, "user_id": int(uid) if uid.lstrip("-").isdigit() else 0, "score": 0})
+_EMOJI_WORDS, _EMOJI_LEXICON_RE = _compile_emoji_lexicon()
+emoji_classifier_stats = {"calls": 0, "lexicon_hits": 0, "polarity_fallbacks": 0, "total_us": 0, "max_us": 0}
+
+def classify_emoji(text: str) -> str:
+    """
+    In-process replacement for ai_emoji(): pick a reaction from the keyword /
+    emoji lexicon (most frequent category wins, "question" only if nothing
+    else matched), falling back to TextBlob polarity via analyze_sentiment().
+    No network, typically a few microseconds per message.
+    """
+    start = time.perf_counter()
+    text = text[:400]
+    counts = {}
+    for w in re.findall(r"[a-z]+", text.lower()):
+        cat = _EMOJI_WORDS.get(w)
+        if cat:
+            counts[cat] = counts.get(cat, 0) + 1
+    for m in _EMOJI_LEXICON_RE.finditer(text):
+        counts[m.lastgroup] = counts.get(m.lastgroup, 0) + 1
+    if len(counts) > 1:
+        counts.pop("question", None)
+    if counts:
+        cat = max(counts, key=counts.get)
+        emoji = random.choice(EMOJI_LEXICON[cat][1])
+        emoji_classifier_stats["lexicon_hits"] += 1
+    else:
+        _, emoji = analyze_sentiment(text)
+        emoji_classifier_stats["polarity_fallbacks"] += 1
+    took = int((time.perf_counter() - start) * 1_000_000)
+    emoji_classifier_stats["calls"] += 1
+    emoji_classifier_stats["total_us"] += took
+    emoji_classifier_stats["max_us"] = max(emoji_classifier_stats["max_us"], took)
+    return emoji
+
+async def bump_score(cid: str, uid: str, name: str, delta: int) -> int:
+    """Update a user's score in the cache (loading it from storage on a miss;
+    raises if that load fails) and in the chat's rank index if loaded. The
+    applied change is queued as a dirty delta and persisted by the
+    write-behind flush (periodic_sync)."""
+    e = await _score_entry(cid, uid, name)
+    old = e["score"]
     e["name"] = name
-    e["score"] = max(0, e["score"] + delta)
-    db["scores"][cid][uid] = e
+    e["score"] = max(0, old + delta)
+    _rank_note(cid, uid, old, e)
+    mark_score_dirty(cid, uid, e["score"] - old, e["name"], e["user_id"])
     return e["score"]
 
 GROQ_MODEL = "openai/gpt-oss-20b"
 OR_MODEL = "openai/gpt-oss-20b:free"
 OR_BASE = "https://openrouter.ai/api/v1"
 
-ai_model_state = {"mode": "auto", "groq_rl_until": 0.0, "or_rl_until": 0.0}
+ai_model_state = {"mode": "auto"}
+
+AI_POOL_LIMIT = int(os.environ.get("AI_POOL_LIMIT", "20"))
+AI_KEEPALIVE_SECS = 60
+
+_ai_sessions = {"groq": None, "or": None}
+ai_http_stats = {
+    "groq": {"requests": 0, "new_connections": 0, "reused_connections": 0},
+    "or": {"requests": 0, "new_connections": 0, "reused_connections": 0},
+}
+
+def _ai_trace_config(provider: str) -> aiohttp.TraceConfig:
+    """Counts fresh vs reused pooled connections so /health can prove keep-alive works."""
+    tc = aiohttp.TraceConfig()
+    stats = ai_http_stats[provider]
+
+    async def _on_create(session, ctx, params):
+        stats["new_connections"] += 1
+
+    async def _on_reuse(session, ctx, params):
+        stats["reused_connections"] += 1
+
+    async def _on_request(session, ctx, params):
+        stats["requests"] += 1
+
+    tc.on_connection_create_end.append(_on_create)
+    tc.on_connection_reuseconn.append(_on_reuse)
+    tc.on_request_start.append(_on_request)
+    return tc
+
+def _new_ai_session(provider: str) -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(limit=AI_POOL_LIMIT, keepalive_timeout=AI_KEEPALIVE_SECS, ttl_dns_cache=300)
+    return aiohttp.ClientSession(connector=connector, trace_configs=[_ai_trace_config(provider)])
+
+async def init_ai_sessions():
+    """Open one long-lived keep-alive pool per AI provider. Called once from main()."""
+    for provider in _ai_sessions:
+        if _ai_sessions[provider] is None or _ai_sessions[provider].closed:
+            _ai_sessions[provider] = _new_ai_session(provider)
+    logger.info(f"[AI] HTTP pools ready (limit={AI_POOL_LIMIT}, keepalive={AI_KEEPALIVE_SECS}s)")
+
+async def close_ai_sessions():
+    for provider, session in _ai_sessions.items():
+        if session is not None and not session.closed:
+            try:
+                await session.close()
+            except Exception as e:
+                logger.warning(f"[AI] closing {provider} pool failed: {e}")
+        _ai_sessions[provider] = None
+
+def _ai_session(provider: str) -> aiohttp.ClientSession:
+    """Shared pooled session for a provider; lazily (re)created if main() hasn't opened it yet."""
+    session = _ai_sessions.get(provider)
+    if session is None or session.closed:
+        session = _new_ai_session(provider)
+        _ai_sessions[provider] = session
+    return session
+
+AI_RL_DEFAULTS = {
+    "groq": (int(os.environ.get("GROQ_RPM", "30")), int(os.environ.get("GROQ_TPM", "8000"))),
+    "or": (int(os.environ.get("OR_RPM", "20")), int(os.environ.get("OR_TPM", "20000"))),
+}
+AI_RL_LOW_RESERVE = 0.25       # low-priority callers need this share of the bucket left, else they're shed
+AI_RL_DEFAULT_BACKOFF = 20     # used on a 429 that carries no Retry-After / reset hint
+
+ai_rate_state = {
+    p: {"rpm": rpm, "tpm": tpm, "req_avail": float(rpm), "tok_avail": float(tpm), "updated": time.time(), "blocked_until": 0.0}
+    for p, (rpm, tpm) in AI_RL_DEFAULTS.items()
+}
+ai_rate_stats = {p: {"queued": 0, "shed": 0, "throttled": 0} for p in AI_RL_DEFAULTS}
 
 def _groq_rate_limited() -> bool:
-    return time.time() < ai_model_state["groq_rl_until"]
+    return time.time() < ai_rate_state["groq"]["blocked_until"]
 
 def _or_rate_limited() -> bool:
-    return time.time() < ai_model_state["or_rl_until"]
+    return time.time() < ai_rate_state["or"]["blocked_until"]
 
-def _set_groq_rl():
-    ai_model_state["groq_rl_until"] = time.time() + 20
-    logger.warning("[AI] Groq rate-limited — backing off 20s")
+def _parse_reset_secs(value: Optional[str]) -> Optional[float]:
+    """Seconds-from-now for Retry-After / x-ratelimit-reset-* values ("7.66s", "2m59.5s", "120ms", "30", epoch s/ms)."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        n = float(value)
+        if n > 1e12:
+            return max(0.0, n / 1000 - time.time())
+        if n > 1e9:
+            return max(0.0, n - time.time())
+        return max(0.0, n)
+    except ValueError:
+        pass
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    parts = re.findall(r"([\d.]+)(ms|h|m|s)", value)
+    return sum(float(n) * units[u] for n, u in parts) if parts else None
+
+def _rl_refill(st: dict, now: float):
+    elapsed = max(0.0, now - st["updated"])
+    st["req_avail"] = min(st["rpm"], st["req_avail"] + elapsed * st["rpm"] / 60)
+    st["tok_avail"] = min(st["tpm"], st["tok_avail"] + elapsed * st["tpm"] / 60)
+    st["updated"] = now
+
+def _rl_update_from_headers(provider: str, headers):
+    """Sync the local buckets with whatever x-ratelimit-* hints the provider sent back."""
+    st = ai_rate_state[provider]
+    now = time.time()
+    _rl_refill(st, now)
+    try:
+        if headers.get("x-ratelimit-limit-tokens"):
+            st["tpm"] = max(1, int(float(headers["x-ratelimit-limit-tokens"])))
+        if headers.get("x-ratelimit-remaining-tokens"):
+            st["tok_avail"] = min(st["tpm"], float(headers["x-ratelimit-remaining-tokens"]))
+        remaining = headers.get("x-ratelimit-remaining-requests") or headers.get("x-ratelimit-remaining")
+        if remaining is not None and float(remaining) <= 0:
+            reset = _parse_reset_secs(headers.get("x-ratelimit-reset-requests") or headers.get("x-ratelimit-reset"))
+            if reset:
+                st["blocked_until"] = max(st["blocked_until"], now + reset)
+    except (TypeError, ValueError):
+        pass
 
-def _set_or_rl():
-    ai_model_state["or_rl_until"] = time.time() + 20
-    logger.warning("[AI] OpenRouter rate-limited — backing off 20s")
+def _set_rl(provider: str, headers=None):
+    """429 handler: block the provider for Retry-After (or the reset hint), not a fixed window."""
+    st = ai_rate_state[provider]
+    wait = None
+    if headers is not None:
+        wait = _parse_reset_secs(headers.get("retry-after")) \
+            or _parse_reset_secs(headers.get("x-ratelimit-reset-tokens")) \
+            or _parse_reset_secs(headers.get("x-ratelimit-reset-requests")) \
+            or _parse_reset_secs(headers.get("x-ratelimit-reset"))
+    wait = wait if wait else AI_RL_DEFAULT_BACKOFF
+    st["blocked_until"] = time.time() + wait
+    st["req_avail"] = 0.0
+    ai_rate_stats[provider]["throttled"] += 1
+    logger.warning(f"[AI] {'Groq' if provider == 'groq' else 'OpenRouter'} rate-limited — backing off {wait:.1f}s")
+
+async def _rl_acquire(provider: str, est_tokens: int, priority: str = "normal") -> bool:
+    """
+    Token-bucket admission (requests/min + tokens/min). Normal callers queue
+    until there is budget (the caller's own timeout bounds the wait); "low"
+    callers such as ai_emoji are shed immediately once the bucket is below
+    AI_RL_LOW_RESERVE. Returns False if the call was shed.
+    """
+    st = ai_rate_state[provider]
+    queued = False
+    while True:
+        now = time.time()
+        _rl_refill(st, now)
+        need_tok = min(est_tokens, st["tpm"])
+        reserve = AI_RL_LOW_RESERVE if priority == "low" else 0.0
+        if now < st["blocked_until"]:
+            wait = st["blocked_until"] - now
+        elif st["req_avail"] >= 1 + reserve * st["rpm"] and st["tok_avail"] >= need_tok + reserve * st["tpm"]:
+            st["req_avail"] -= 1
+            st["tok_avail"] -= need_tok
+            return True
+        else:
+            wait = max((1 - st["req_avail"]) * 60 / st["rpm"], (need_tok - st["tok_avail"]) * 60 / st["tpm"], 0.05)
+        if priority == "low":
+            ai_rate_stats[provider]["shed"] += 1
+            return False
+        if not queued:
+            ai_rate_stats[provider]["queued"] += 1
+            queued = True
+        await asyncio.sleep(min(wait, 1.0))
+
+def _est_tokens(system: str, user: str, max_tok: int) -> int:
+    return (len(system) + len(user)) // 4 + max_tok
+
+def ai_rate_summary() -> dict:
+    now = time.time()
+    out = {}
+    for provider, st in ai_rate_state.items():
+        _rl_refill(st, now)
+        out[provider] = {
+            "rpm": st["rpm"], "tpm": st["tpm"],
+            "req_avail": round(st["req_avail"], 1), "tok_avail": int(st["tok_avail"]),
+            "blocked_for_s": round(max(0.0, st["blocked_until"] - now), 1),
+            **ai_rate_stats[provider],
+        }
+    return out
+
+AI_BREAKER_WINDOW_SECS = 120
+AI_BREAKER_MIN_SAMPLES = 5
+AI_BREAKER_ERROR_RATE = 0.5
+AI_BREAKER_SLOW_P95_MS = int(os.environ.get("AI_BREAKER_SLOW_P95_MS", "11000"))
+AI_BREAKER_COOLDOWN = 30
+AI_BREAKER_PROBE_TIMEOUT = 30
+
+ai_breakers = {
+    p: {"state": "closed", "window": deque(maxlen=200), "open_until": 0.0, "probe_started": 0.0, "opened": 0}
+    for p in ("groq", "or")
+}
 
-async def _call_groq(system: str, user: str, max_tok: int) -> Optional[str]:
+def _percentile(samples: list, pct: float):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct))]
+
+def _breaker_window(provider: str) -> list:
+    cutoff = time.time() - AI_BREAKER_WINDOW_SECS
+    return [w for w in ai_breakers[provider]["window"] if w[0] >= cutoff]
+
+def _breaker_state(provider: str) -> str:
+    """closed / open / half_open; an open breaker turns half_open once its cooldown has passed."""
+    br = ai_breakers[provider]
+    if br["state"] == "open" and time.time() >= br["open_until"]:
+        br["state"], br["probe_started"] = "half_open", 0.0
+    return br["state"]
+
+def _breaker_allow(provider: str) -> bool:
+    """Gate a real request: closed always passes, half_open lets one probe through at a time."""
+    state = _breaker_state(provider)
+    if state == "closed":
+        return True
+    if state == "half_open":
+        br = ai_breakers[provider]
+        if time.time() - br["probe_started"] > AI_BREAKER_PROBE_TIMEOUT:
+            br["probe_started"] = time.time()
+            return True
+    return False
+
+def _breaker_record(provider: str, ok: bool, latency_ms: int = 0):
+    """Feed one outcome (5xx/exception/timeout = not ok; 429s are the rate limiter's business)."""
+    br = ai_breakers[provider]
+    br["window"].append((time.time(), ok, latency_ms))
+    state = _breaker_state(provider)
+    if state == "half_open":
+        if ok:
+            br["state"] = "closed"
+            br["window"].clear()
+            logger.info(f"[AI] {provider} breaker closed after successful probe")
+        else:
+            _breaker_trip(provider, "probe failed")
+        return
+    if state != "closed":
+        return
+    window = _breaker_window(provider)
+    if len(window) < AI_BREAKER_MIN_SAMPLES:
+        return
+    err_rate = sum(1 for w in window if not w[1]) / len(window)
+    p95 = _percentile([w[2] for w in window if w[1]], 0.95)
+    if err_rate >= AI_BREAKER_ERROR_RATE:
+        _breaker_trip(provider, f"error rate {err_rate:.0%}")
+    elif p95 is not None and p95 > AI_BREAKER_SLOW_P95_MS:
+        _breaker_trip(provider, f"p95 {p95}ms")
+
+# Set inside each hedged race leg. Once one leg wins, the others are marked
+# "lost" before being cancelled, so that cancellation isn't held against the
+# provider; legs cut off by the race deadline still count as failures.
+_ai_race_leg: contextvars.ContextVar = contextvars.ContextVar("ai_race_leg", default=None)
+
+def _breaker_record_cancel(provider: str):
+    """A request cancelled mid-flight (an outer wait_for timing out on a hung
+    provider) counts as a failure, unless it was a race leg that simply lost."""
+    leg = _ai_race_leg.get()
+    if leg is None or not leg["lost"]:
+        bot_status["failed_apis"] += 1
+        _breaker_record(provider, False)
+
+def _breaker_trip(provider: str, reason: str):
+    br = ai_breakers[provider]
+    br["state"], br["open_until"] = "open", time.time() + AI_BREAKER_COOLDOWN
+    br["opened"] += 1
+    logger.warning(f"[AI] {provider} breaker OPEN for {AI_BREAKER_COOLDOWN}s ({reason})")
+
+def ai_breaker_summary() -> dict:
+    out = {}
+    for provider, br in ai_breakers.items():
+        window = _breaker_window(provider)
+        lat = [w[2] for w in window if w[1]]
+        out[provider] = {
+            "state": _breaker_state(provider), "samples": len(window), "opened": br["opened"],
+            "error_rate": round(sum(1 for w in window if not w[1]) / len(window), 3) if window else 0.0,
+            "p50_ms": _percentile(lat, 0.5), "p95_ms": _percentile(lat, 0.95),
+        }
+    return out
+
+GROQ_URL = "https://api.groq.com/openai/v1/chat/completions"
+
+def _provider_endpoint(provider: str) -> tuple:
+    """(url, headers) for a provider's OpenAI-compatible chat/completions endpoint."""
+    if provider == "groq":
+        return GROQ_URL, {"Authorization": f"Bearer {GROQ_KEY}", "Content-Type": "application/json"}
+    return f"{OR_BASE}/chat/completions", {
+        "Authorization": f"Bearer {OPENROUTER_KEY}",
+        "Content-Type": "application/json",
+        "HTTP-Referer": "https://t.me/BELUGAPY",
+        "X-Title": "BelugaBot"
+    }
+
+async def _call_groq(system: str, user: str, max_tok: int, priority: str = "normal") -> Optional[str]:
     if not GROQ_KEY:
         logger.warning("[AI] GROQ_API_KEY not set")
         return None
+    if not _breaker_allow("groq"):
+        return None
+    if not await _rl_acquire("groq", _est_tokens(system, user, max_tok), priority):
+        return None
     bot_status["api_calls"] += 1
+    start = time.monotonic()
     try:
-        async with aiohttp.ClientSession() as session:
-            payload = {
-                "model": GROQ_MODEL,
-                "messages": [{"role": "system", "content": system}, {"role": "user", "content": user}],
-                "max_tokens": max_tok
-            }
-            async with session.post(
-                "https://api.groq.com/openai/v1/chat/completions",
-                headers={"Authorization": f"Bearer {GROQ_KEY}", "Content-Type": "application/json"},
-                json=payload,
-                timeout=aiohttp.ClientTimeout(total=12)
-            ) as r:
-                if r.status == 200:
-                    data = await r.json()
-                    return data["choices"][0]["message"]["content"].strip()
-                elif r.status == 429:
-                    _set_groq_rl()
-                    return None
-                else:
-                    body = await r.text()
-                    logger.error(f"[AI] Groq error {r.status}: {body[:300]}")
-                    bot_status["failed_apis"] += 1
+        session = _ai_session("groq")
+        url, headers = _provider_endpoint("groq")
+        payload = {
+            "model": GROQ_MODEL,
+            "messages": [{"role": "system", "content": system}, {"role": "user", "content": user}],
+            "max_tokens": max_tok
+        }
+        async with session.post(url, headers=headers, json=payload, timeout=aiohttp.ClientTimeout(total=12)) as r:
+            _rl_update_from_headers("groq", r.headers)
+            if r.status == 200:
+                data = await r.json()
+                _breaker_record("groq", True, int((time.monotonic() - start) * 1000))
+                return data["choices"][0]["message"]["content"].strip()
+            elif r.status == 429:
+                _set_rl("groq", r.headers)
+                return None
+            else:
+                body = await r.text()
+                logger.error(f"[AI] Groq error {r.status}: {body[:300]}")
+                bot_status["failed_apis"] += 1
+                _breaker_record("groq", False)
+    except asyncio.CancelledError:
+        _breaker_record_cancel("groq")
+        raise
     except Exception as e:
         logger.error(f"[AI] Groq exception: {e}")
         bot_status["failed_apis"] += 1
+        _breaker_record("groq", False)
     return None
 
-async def _call_openrouter(system: str, user: str, max_tok: int) -> Optional[str]:
+async def _call_openrouter(system: str, user: str, max_tok: int, priority: str = "normal") -> Optional[str]:
     if not OPENROUTER_KEY:
         logger.warning("[AI] OPENROUTER_API_KEY not set")
         return None
+    if not _breaker_allow("or"):
+        return None
+    if not await _rl_acquire("or", _est_tokens(system, user, max_tok), priority):
+        return None
     bot_status["api_calls"] += 1
+    start = time.monotonic()
     try:
-        async with aiohttp.ClientSession() as session:
-            payload = {
-                "model": OR_MODEL,
-                "messages": [{"role": "system", "content": system}, {"role": "user", "content": user}],
-                "max_tokens": max_tok
-            }
-            async with session.post(
-                f"{OR_BASE}/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {OPENROUTER_KEY}",
-                    "Content-Type": "application/json",
-                    "HTTP-Referer": "https://t.me/BELUGAPY",
-                    "X-Title": "BelugaBot"
-                },
-                json=payload,
-                timeout=aiohttp.ClientTimeout(total=15)
-            ) as r:
-                if r.status == 200:
-                    data = await r.json()
-                    return data["choices"][0]["message"]["content"].strip()
-                elif r.status == 429:
-                    _set_or_rl()
-                    return None
-                else:
-                    body = await r.text()
-                    logger.error(f"[AI] OpenRouter error {r.status}: {body[:300]}")
-                    bot_status["failed_apis"] += 1
+        session = _ai_session("or")
+        url, headers = _provider_endpoint("or")
+        payload = {
+            "model": OR_MODEL,
+            "messages": [{"role": "system", "content": system}, {"role": "user", "content": user}],
+            "max_tokens": max_tok
+        }
+        async with session.post(url, headers=headers, json=payload, timeout=aiohttp.ClientTimeout(total=15)) as r:
+            _rl_update_from_headers("or", r.headers)
+            if r.status == 200:
+                data = await r.json()
+                _breaker_record("or", True, int((time.monotonic() - start) * 1000))
+                return data["choices"][0]["message"]["content"].strip()
+            elif r.status == 429:
+                _set_rl("or", r.headers)
+                return None
+            else:
+                body = await r.text()
+                logger.error(f"[AI] OpenRouter error {r.status}: {body[:300]}")
+                bot_status["failed_apis"] += 1
+                _breaker_record("or", False)
+    except asyncio.CancelledError:
+        _breaker_record_cancel("or")
+        raise
     except Exception as e:
         logger.error(f"[AI] OpenRouter exception: {e}")
         bot_status["failed_apis"] += 1
+        _breaker_record("or", False)
     return None
 
-async def ai(system: str, user: str, fallback: str = "Meow! 🐾", max_tok: int = 200) -> str:
+async def _stream_provider(provider: str, system: str, user: str, max_tok: int):
     """
-    Smart dual-provider AI call.
-    Mode 'gro' → Groq only (auto-falls back to OR if rate-limited in auto spirit).
-    Mode 'rou' → OpenRouter only (auto-falls back to Groq if rate-limited).
-    Mode 'auto' → tries Groq first, then OR on any failure.
-    If OpenRouter is active, uses CHAT_PROMPT_OR (Hinglish+English, 2-3 lines).
+    Server-sent-events variant of _call_groq/_call_openrouter. Yields content
+    deltas as they arrive. Yields nothing on 429 / non-200 / missing key, so
+    callers can fall through to the next provider exactly like ai() does.
     """
-    mode = ai_model_state["mode"]
-
-    if mode == "gro":
-        order = ["groq", "or"]
-    elif mode == "rou":
-        order = ["or", "groq"]
-    else:
-        order = ["groq", "or"]
-
-    for provider in order:
-        try:
-            if provider == "groq":
-                if _groq_rate_limited():
+    key = GROQ_KEY if provider == "groq" else OPENROUTER_KEY
+    if not key or not _breaker_allow(provider):
+        return
+    if not await _rl_acquire(provider, _est_tokens(system, user, max_tok)):
+        return
+    bot_status["api_calls"] += 1
+    start = time.monotonic()
+    url, headers = _provider_endpoint(provider)
+    payload = {
+        "model": GROQ_MODEL if provider == "groq" else OR_MODEL,
+        "messages": [{"role": "system", "content": system}, {"role": "user", "content": user}],
+        "max_tokens": max_tok,
+        "stream": True,
+    }
+    timeout = aiohttp.ClientTimeout(total=12 if provider == "groq" else 15)
+    try:
+        async with _ai_session(provider).post(url, headers=headers, json=payload, timeout=timeout) as r:
+            _rl_update_from_headers(provider, r.headers)
+            if r.status == 429:
+                _set_rl(provider, r.headers)
+                return
+            if r.status != 200:
+                body = await r.text()
+                logger.error(f"[AI] {provider} stream error {r.status}: {body[:300]}")
+                bot_status["failed_apis"] += 1
+                _breaker_record(provider, False)
+                return
+            async for raw in r.content:
+                line = raw.decode("utf-8", "ignore").strip()
+                if not line.startswith("data:"):
                     continue
-                res = await asyncio.wait_for(_call_groq(system, user, max_tok), timeout=14)
-            else:
-                if _or_rate_limited():
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    delta = json.loads(data)["choices"][0].get("delta", {}).get("content")
+                except Exception:
                     continue
-                or_system = CHAT_PROMPT_OR if system.startswith(CHAT_PROMPT) else system
-                res = await asyncio.wait_for(_call_openrouter(or_system, user, max_tok), timeout=16)
+                if delta:
+                    yield delta
+        _breaker_record(provider, True, int((time.monotonic() - start) * 1000))
+    except asyncio.CancelledError:
+        _breaker_record_cancel(provider)
+        raise
+    except Exception:
+        bot_status["failed_apis"] += 1
+        _breaker_record(provider, False)
+        raise
+
+def _ai_order() -> list:
+    """Provider try-order: the /model mode's preference, re-ranked so healthy (closed-breaker) providers go first."""
+    preferred = ["or", "groq"] if ai_model_state["mode"] == "rou" else ["groq", "or"]
+    rank = {"closed": 0, "half_open": 1, "open": 2}
+    return sorted(preferred, key=lambda p: rank[_breaker_state(p)])
+
+def _or_system(system: str) -> str:
+    """Swap in CHAT_PROMPT_OR for OpenRouter, keeping any per-user context appended after the base prompt."""
+    return CHAT_PROMPT_OR + system[len(CHAT_PROMPT):] if system.startswith(CHAT_PROMPT) else system
+
+def _provider_rate_limited(provider: str) -> bool:
+    return _groq_rate_limited() if provider == "groq" else _or_rate_limited()
+
+def _provider_unavailable(provider: str) -> bool:
+    """Skip a provider while it is rate-limited or its breaker is open."""
+    return _provider_rate_limited(provider) or _breaker_state(provider) == "open"
+
+AI_CACHE_MAX = int(os.environ.get("AI_CACHE_MAX", "512"))
+AI_CACHE_TTL_QUIZ = 1800
+AI_CACHE_TTL_SEARCH = 1800
+AI_CACHE_TTL_EMOJI = 21600
+
+ai_cache: OrderedDict = OrderedDict()  # key -> (expires_at, text), oldest first
+ai_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+
+def _ai_cache_key(system: str, user: str, max_tok: int, provider: str) -> str:
+    """Whitespace/case-normalised (system, user, max_tok, provider) digest."""
+    norm = lambda t: re.sub(r"\s+", " ", t).strip().lower()
+    raw = "\x1f".join([norm(system), norm(user), str(max_tok), provider])
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+def _ai_cache_get(key: str) -> Optional[str]:
+    hit = ai_cache.get(key)
+    if hit is None:
+        ai_cache_stats["misses"] += 1
+        return None
+    if hit[0] < time.time():
+        del ai_cache[key]
+        ai_cache_stats["expired"] += 1
+        ai_cache_stats["misses"] += 1
+        return None
+    ai_cache.move_to_end(key)
+    ai_cache_stats["hits"] += 1
+    return hit[1]
+
+def _ai_cache_put(key: str, text: str, ttl: int):
+    ai_cache[key] = (time.time() + ttl, text)
+    ai_cache.move_to_end(key)
+    while len(ai_cache) > AI_CACHE_MAX:
+        ai_cache.popitem(last=False)
+        ai_cache_stats["evictions"] += 1
+
+def ai_cache_summary() -> dict:
+    looked_up = ai_cache_stats["hits"] + ai_cache_stats["misses"]
+    return {**ai_cache_stats, "size": len(ai_cache), "max": AI_CACHE_MAX,
+            "hit_rate": round(ai_cache_stats["hits"] / looked_up, 3) if looked_up else 0.0}
+
+AI_DEADLINE = float(os.environ.get("AI_DEADLINE", "25"))
+AI_HEDGE_PERCENTILE = float(os.environ.get("AI_HEDGE_PERCENTILE", "0.9"))
+AI_HEDGE_DEFAULT_SECS = 4.0
+AI_PROVIDER_TIMEOUT = {"groq": 14, "or": 16}
+
+ai_latency_ms = {p: deque(maxlen=200) for p in ("groq", "or")}
+ai_race_stats = {"races": 0, "hedged": 0, "wins": {"groq": 0, "or": 0}}
+
+def _hedge_delay(provider: str) -> float:
+    """Seconds to wait on `provider` before firing the backup: its AI_HEDGE_PERCENTILE latency."""
+    samples = sorted(ai_latency_ms[provider])
+    if len(samples) < 10:
+        return AI_HEDGE_DEFAULT_SECS
+    idx = min(len(samples) - 1, int(len(samples) * AI_HEDGE_PERCENTILE))
+    return max(0.5, min(10.0, samples[idx] / 1000))
+
+async def _call_provider(provider: str, system: str, user: str, max_tok: int, budget: float) -> Optional[str]:
+    """One provider call capped at min(provider timeout, remaining budget); records latency on success."""
+    start = time.monotonic()
+    timeout = max(0.1, min(AI_PROVIDER_TIMEOUT[provider], budget))
+    if provider == "groq":
+        res = await asyncio.wait_for(_call_groq(system, user, max_tok), timeout=timeout)
+    else:
+        res = await asyncio.wait_for(_call_openrouter(_or_system(system), user, max_tok), timeout=timeout)
+    if res:
+        ai_latency_ms[provider].append(int((time.monotonic() - start) * 1000))
+    return res
+
+async def _ai_sequential(system: str, user: str, max_tok: int, deadline: float) -> Optional[str]:
+    """Each provider in _ai_order(), then one retry pass, all inside `deadline`."""
+    order = _ai_order()
+    for attempt, provider in enumerate(order * 2):
+        budget = deadline - time.monotonic()
+        if budget <= 0:
+            logger.warning("[AI] deadline reached")
+            break
+        if _provider_unavailable(provider):
+            continue
+        try:
+            res = await _call_provider(provider, system, user, max_tok, budget)
             if res:
+                if attempt >= len(order):
+                    logger.info(f"[AI] {provider} succeeded on retry pass")
                 return res
         except asyncio.TimeoutError:
             logger.warning(f"[AI] {provider} timed out")
         except Exception as e:
             logger.warning(f"[AI] {provider} error: {e}")
+    return None
 
-    # Both providers failed on first pass — give each one more shot before
-    # falling back, in case it was a transient network blip rather than a
-    # real rate limit or outage.
-    for provider in order:
-        try:
-            if provider == "groq":
-                if _groq_rate_limited():
-                    continue
-                res = await asyncio.wait_for(_call_groq(system, user, max_tok), timeout=14)
-            else:
-                if _or_rate_limited():
-                    continue
-                or_system = CHAT_PROMPT_OR if system.startswith(CHAT_PROMPT) else system
-                res = await asyncio.wait_for(_call_openrouter(or_system, user, max_tok), timeout=16)
-            if res:
-                logger.info(f"[AI] {provider} succeeded on retry pass")
-                return res
-        except asyncio.TimeoutError:
-            logger.warning(f"[AI] {provider} timed out on retry")
-        except Exception as e:
-            logger.warning(f"[AI] {provider} error on retry: {e}")
+async def _ai_race(system: str, user: str, max_tok: int, deadline: float) -> Optional[str]:
+    """
+    Hedged request: start the primary, and if it hasn't answered within its
+    percentile latency fire the secondary too. First non-empty answer wins and
+    the loser is cancelled. A fast failure also triggers the secondary at once.
+    """
+    providers = [p for p in _ai_order() if not _provider_unavailable(p)]
+    if not providers:
+        return None
+    ai_race_stats["races"] += 1
+    pending, legs = {}, {}
+
+    async def _leg(provider, leg):
+        _ai_race_leg.set(leg)
+        return await _call_provider(provider, system, user, max_tok, deadline - time.monotonic())
+
+    def _launch(provider):
+        leg = {"lost": False}
+        task = asyncio.create_task(_leg(provider, leg))
+        pending[task], legs[task] = provider, leg
+
+    _launch(providers[0])
+    backups = providers[1:]
+    hedge_at = time.monotonic() + _hedge_delay(providers[0])
+    try:
+        while pending:
+            now = time.monotonic()
+            if now >= deadline:
+                logger.warning("[AI] race deadline reached")
+                return None
+            wait_for = deadline - now
+            if backups:
+                wait_for = max(0.0, min(wait_for, hedge_at - now))
+            done, _ = await asyncio.wait(pending.keys(), timeout=wait_for, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                provider = pending.pop(task)
+                try:
+                    res = task.result()
+                except Exception as e:
+                    logger.warning(f"[AI] {provider} race leg failed: {e}")
+                    res = None
+                if res:
+                    ai_race_stats["wins"][provider] += 1
+                    for leg in legs.values():
+                        leg["lost"] = True
+                    return res
+            if backups and (not pending or time.monotonic() >= hedge_at):
+                if pending:
+                    ai_race_stats["hedged"] += 1
+                _launch(backups.pop(0))
+        return None
+    finally:
+        for task in pending:
+            task.cancel()
 
-    logger.error("[AI] Both providers failed twice — returning fallback")
-    return fallback
+async def _ai_providers(system: str, user: str, max_tok: int, deadline: Optional[float] = None) -> Optional[str]:
+    """
+    Provider dispatch behind ai(), bounded by one AI_DEADLINE for the whole
+    call (or by the caller's `deadline`, a monotonic timestamp, when it has
+    already spent part of it). 'race' mode hedges across providers; every
+    other mode tries them in order. Returns None if every provider failed.
+    """
+    if deadline is None:
+        deadline = time.monotonic() + AI_DEADLINE
+    if ai_model_state["mode"] == "race":
+        res = await _ai_race(system, user, max_tok, deadline)
+        if res or time.monotonic() >= deadline:
+            return res
+        res = await _ai_sequential(system, user, max_tok, deadline)
+    else:
+        res = await _ai_sequential(system, user, max_tok, deadline)
+    if not res:
+        logger.error("[AI] All providers failed within the deadline")
+    return res
+
+async def ai(system: str, user: str, fallback: str = "Meow! 🐾", max_tok: int = 200, cache_ttl: int = 0) -> str:
+    """
+    Smart dual-provider AI call.
+    Mode 'gro' → Groq only (auto-falls back to OR if rate-limited in auto spirit).
+    Mode 'rou' → OpenRouter only (auto-falls back to Groq if rate-limited).
+    Mode 'auto' → tries Groq first, then OR on any failure.
+    Mode 'race' → hedges: OR is fired alongside Groq once Groq runs slow.
+    If OpenRouter is active, uses CHAT_PROMPT_OR (Hinglish+English, 2-3 lines).
+    cache_ttl > 0 serves/stores the answer in the response cache for that many
+    seconds; the default 0 keeps the personality chat path uncached.
+    """
+    key = _ai_cache_key(system, user, max_tok, ai_model_state["mode"]) if cache_ttl > 0 else None
+    if key:
+        hit = _ai_cache_get(key)
+        if hit is not None:
+            return hit
+    res = await _ai_providers(system, user, max_tok)
+    if not res:
+        return fallback
+    if key:
+        _ai_cache_put(key, res, cache_ttl)
+    return res
 
 async def ai_emoji(text: str) -> str:
     """Quick emoji pick — always uses Groq (lightweight, no Hinglish needed)."""
+    system, prompt = "Output ONE emoji matching emotion. ONLY the emoji, nothing else.", f"Text: '{text[:60]}'"
+    key = _ai_cache_key(system, prompt, 10, "groq")
+    hit = _ai_cache_get(key)
+    if hit is not None:
+        return hit
     try:
-        res = await asyncio.wait_for(
-            _call_groq("Output ONE emoji matching emotion. ONLY the emoji, nothing else.", f"Text: '{text[:60]}'", 10),
-            timeout=6
-        )
+        res = await asyncio.wait_for(_call_groq(system, prompt, 10, priority="low"), timeout=6)
         if res:
             found = re.findall(r"[^\w\s,.:!?'\"\(\)\-]+", res)
             if found:
+                _ai_cache_put(key, found[0][0], AI_CACHE_TTL_EMOJI)
                 return found[0][0]
     except Exception:
         pass
     return "😼"
 
+EMOJI_MODE = os.environ.get("EMOJI_MODE", "local")  # "local" lexicon, "ai" for ai_emoji(), "combined" for the reply envelope
+
+TG_REACTIONS = frozenset(
+    "👍 👎 ❤ 🔥 🥰 👏 😁 🤔 🤯 😱 🤬 😢 🎉 🤩 🤮 💩 🙏 👌 🕊 🤡 🥱 🥴 😍 🐳 ❤‍🔥 🌚 🌭 💯 🤣 ⚡ 🍌 🏆 💔 🤨 😐 🍓 🍾 💋 "
+    "😈 😴 😭 🤓 👻 👨‍💻 👀 🎃 🙈 😇 😨 🤝 ✍ 🤗 🫡 🎅 🎄 ☃ 💅 🤪 🗿 🆒 💘 🙉 🦄 😘 💊 🙊 😎 👾 🤷‍♂ 🤷 🤷‍♀ 😡".split()
+)
+REACTION_ENVELOPE_PROMPT = (
+    "\n\nFormat: start your answer with exactly ONE reaction emoji for the user's message inside double "
+    "square brackets, then your reply. Example: [[🔥]] your reply here"
+)
+ENVELOPE_MAX_PREFIX = 40
+_ENVELOPE_RE = re.compile(r"^\s*(?:\[\[\s*([^\]\n]{1,16}?)\s*\]\]|(?:emoji|reaction)\s*[:=]\s*(\S{1,16})[ \t]*(?:\n|$))\s*", re.IGNORECASE)
+envelope_stats = {"parsed": 0, "malformed": 0}
+
+def _valid_reaction(emoji) -> Optional[str]:
+    if not isinstance(emoji, str):
+        return None
+    emoji = emoji.strip().replace("\ufe0f", "")
+    return emoji if emoji in TG_REACTIONS else None
+
+def parse_reaction_envelope(raw: str) -> tuple:
+    """
+    Split a combined completion into (reaction_emoji_or_None, reply_text).
+    Accepts "[[🔥]] reply", "EMOJI: 🔥\nreply" or a {"emoji":..,"reply":..}
+    object; anything else is treated as a plain reply with no reaction.
+    """
+    m = _ENVELOPE_RE.match(raw or "")
+    if m:
+        emoji = _valid_reaction(m.group(1) or m.group(2))
+        envelope_stats["parsed" if emoji else "malformed"] += 1
+        return emoji, raw[m.end():].strip()
+    j = re.search(r"\{[\s\S]*\}", raw or "")
+    if j:
+        try:
+            d = json.loads(j.group(0))
+            reply = str(d.get("reply", "")).strip()
+            if reply:
+                envelope_stats["parsed"] += 1
+                return _valid_reaction(d.get("emoji")), reply
+        except Exception:
+            pass
+    envelope_stats["malformed"] += 1
+    return None, (raw or "").strip()
+
+def _envelope_ready(raw: str) -> bool:
+    """Enough streamed text to decide whether an envelope prefix is present."""
+    head = raw.lstrip()
+    return "]]" in head or "\n" in head or len(head) >= ENVELOPE_MAX_PREFIX or (head[:1] not in ("", "[", "E", "e", "R", "r"))
+
+def _resolve_envelope(state: dict):
+    emoji, state["text"] = parse_reaction_envelope(state["raw"])
+    state["env_done"] = True
+    state["on_reaction"](emoji)
+
+AI_STREAMING = os.environ.get("AI_STREAMING", "1") == "1"
+STREAM_EDIT_INTERVAL = 1.2   # Telegram tolerates roughly one edit/sec per chat
+STREAM_MIN_DELTA = 12        # don't burn an edit on a couple of new characters
+STREAM_CURSOR = " ▌"
+
+ai_stream_stats = {p: {"streams": 0, "edits": 0, "ttft_ms": deque(maxlen=100)} for p in ("groq", "or")}
+
+def ai_stream_summary() -> dict:
+    """Per-provider time-to-first-visible-text, for /health and /model."""
+    out = {}
+    for provider, st in ai_stream_stats.items():
+        samples = sorted(st["ttft_ms"])
+        out[provider] = {
+            "streams": st["streams"], "edits": st["edits"],
+            "ttft_p50_ms": samples[len(samples) // 2] if samples else None,
+            "ttft_last_ms": st["ttft_ms"][-1] if samples else None,
+        }
+    return out
+
+def _fmt_ms(ms) -> str:
+    return f"{ms}ms" if ms is not None else "n/a"
+
+async def _stream_into_message(provider: str, message, system: str, user: str, max_tok: int, state: dict):
+    """
+    Stream one provider's completion into a reply to `message`: the first
+    chunk is sent as soon as it arrives, later chunks edit it in place at
+    most every STREAM_EDIT_INTERVAL seconds. Progress lives in `state`
+    ("text", "sent") so a timeout mid-stream still leaves the caller with
+    the message that is already visible. With an envelope pending, nothing
+    is shown until the reaction prefix has been parsed off.
+    """
+    stats = ai_stream_stats[provider]
+    shown = ""
+    start = time.monotonic()
+    last_edit = 0.0
+    async for delta in _stream_provider(provider, system, user, max_tok):
+        if not state["env_done"]:
+            # Hold text back until the [[emoji]] prefix can be stripped.
+            state["raw"] += delta
+            if not _envelope_ready(state["raw"]):
+                continue
+            _resolve_envelope(state)
+        else:
+            state["text"] += delta
+        text, now = state["text"], time.monotonic()
+        if state["sent"] is None:
+            if not text.strip():
+                continue
+            state["sent"] = await message.reply_text(text[:4000] + STREAM_CURSOR, reply_to_message_id=message.message_id)
+            stats["streams"] += 1
+            stats["ttft_ms"].append(int((now - start) * 1000))
+            shown, last_edit = text, now
+        elif now - last_edit >= STREAM_EDIT_INTERVAL and len(text) - len(shown) >= STREAM_MIN_DELTA:
+            try:
+                await state["sent"].edit_text(text[:4000] + STREAM_CURSOR)
+                stats["edits"] += 1
+            except RetryAfter as e:
+                last_edit = now + e.retry_after
+                continue
+            except Exception:
+                pass
+            shown, last_edit = text, now
+
+async def ai_stream_reply(message, system: str, user: str, fallback: str = "Meow! 🐾", max_tok: int = 200,
+                          on_reaction=None) -> str:
+    """
+    Streaming counterpart of `ai()` + `reply_text` for the chat paths. Tries
+    providers in the same order as ai(); once any text is visible the reply
+    is finalised with whatever arrived rather than retried elsewhere. Falls
+    back to the non-streamed provider dispatch if nothing streamed. Streams
+    and fallback share one AI_DEADLINE. In 'race' mode the hedged,
+    non-streamed dispatch is used directly.
+    With on_reaction, the same completion also carries a [[emoji]] envelope:
+    on_reaction gets the parsed emoji (None if malformed) exactly once.
+    Returns the final reply text so callers can store it in chat history.
+    """
+    react_once = None
+    if on_reaction is not None:
+        system += REACTION_ENVELOPE_PROMPT
+        fired = []
+
+        def react_once(emoji):
+            if not fired:
+                fired.append(emoji)
+                on_reaction(emoji)
+
+    deadline = time.monotonic() + AI_DEADLINE
+    if AI_STREAMING and ai_model_state["mode"] != "race":
+        for provider in _ai_order():
+            budget = deadline - time.monotonic()
+            if budget <= 0:
+                break
+            if _provider_unavailable(provider):
+                continue
+            or_system = _or_system(system) if provider == "or" else system
+            state = {"text": "", "sent": None, "raw": "", "env_done": react_once is None, "on_reaction": react_once}
+            try:
+                await asyncio.wait_for(
+                    _stream_into_message(provider, message, or_system, user, max_tok, state),
+                    timeout=max(0.1, min(AI_PROVIDER_TIMEOUT[provider], budget))
+                )
+            except asyncio.TimeoutError:
+                logger.warning(f"[AI] {provider} stream timed out")
+            except Exception as e:
+                logger.warning(f"[AI] {provider} stream error: {e}")
+            if not state["env_done"] and state["raw"].strip():
+                _resolve_envelope(state)
+                if state["text"].strip():
+                    try:
+                        state["sent"] = await message.reply_text(state["text"][:4000], reply_to_message_id=message.message_id)
+                    except Exception:
+                        pass
+            if state["sent"] is not None:
+                final = state["text"].strip() or fallback
+                try:
+                    await state["sent"].edit_text(final[:4000])
+                except Exception:
+                    pass
+                return final
+
+    reply = await _ai_providers(system, user, max_tok, deadline) or fallback
+    if react_once is not None:
+        emoji, reply = parse_reaction_envelope(reply)
+        reply = reply or fallback
+        react_once(emoji)
+    try:
+        await message.reply_text(reply, reply_to_message_id=message.message_id)
+    except Exception:
+        pass
+    return reply
+
+AI_MAX_CONCURRENT = int(os.environ.get("AI_MAX_CONCURRENT", "4"))
+AI_QUEUE_MAX = int(os.environ.get("AI_QUEUE_MAX", "40"))
+AI_CLASSES = ("command", "dm", "ambient", "background")   # highest priority first
+AI_CLASS_MAX_WAIT = {"command": 90.0, "dm": 60.0, "ambient": 20.0, "background": 120.0}
+
+ai_sched = {"running": 0, "queues": {k: OrderedDict() for k in AI_CLASSES}}  # class -> chat_id -> deque[(ts, future)]
+ai_sched_stats = {k: {"admitted": 0, "queued": 0, "rejected": 0, "dropped_stale": 0, "shed": 0} for k in AI_CLASSES}
+
+def _ai_queue_depth() -> int:
+    return sum(len(dq) for q in ai_sched["queues"].values() for dq in q.values())
+
+def _ai_shed_one_ambient() -> bool:
+    """Make room for higher-priority work by dropping the oldest queued ambient request."""
+    q = ai_sched["queues"]["ambient"]
+    for chat_id, dq in list(q.items()):
+        while dq:
+            _, fut = dq.popleft()
+            if not fut.done():
+                fut.set_result(False)
+                ai_sched_stats["ambient"]["shed"] += 1
+                if not dq:
+                    del q[chat_id]
+                return True
+        del q[chat_id]
+    return False
+
+def _ai_dispatch():
+    """Hand free slots to waiters: class priority first, round-robin across chats within a class."""
+    now = time.monotonic()
+    while ai_sched["running"] < AI_MAX_CONCURRENT:
+        granted = False
+        for kind in AI_CLASSES:
+            q = ai_sched["queues"][kind]
+            while q and not granted:
+                chat_id, dq = next(iter(q.items()))
+                ts, fut = dq.popleft()
+                if dq:
+                    q.move_to_end(chat_id)
+                else:
+                    del q[chat_id]
+                if fut.done():
+                    continue
+                if now - ts > AI_CLASS_MAX_WAIT[kind]:
+                    fut.set_result(False)
+                    ai_sched_stats[kind]["dropped_stale"] += 1
+                    continue
+                ai_sched["running"] += 1
+                fut.set_result(True)
+                granted = True
+            if granted:
+                break
+        if not granted:
+            return
+
+async def _ai_admit(kind: str, chat_id) -> bool:
+    stats = ai_sched_stats[kind]
+    if ai_sched["running"] < AI_MAX_CONCURRENT and _ai_queue_depth() == 0:
+        ai_sched["running"] += 1
+        stats["admitted"] += 1
+        return True
+    if _ai_queue_depth() >= AI_QUEUE_MAX and (kind in ("ambient", "background") or not _ai_shed_one_ambient()):
+        stats["rejected"] += 1
+        return False
+    fut = asyncio.get_running_loop().create_future()
+    ai_sched["queues"][kind].setdefault(str(chat_id), deque()).append((time.monotonic(), fut))
+    stats["queued"] += 1
+    try:
+        ok = await asyncio.wait_for(fut, timeout=AI_CLASS_MAX_WAIT[kind])
+    except asyncio.TimeoutError:
+        # _ai_dispatch may have granted the slot just as the wait ran out
+        if fut.done() and not fut.cancelled() and fut.result():
+            _ai_release()
+        stats["dropped_stale"] += 1
+        return False
+    except asyncio.CancelledError:
+        if fut.done() and not fut.cancelled() and fut.result():
+            _ai_release()
+        raise
+    if ok:
+        stats["admitted"] += 1
+    return ok
+
+def _ai_release():
+    ai_sched["running"] = max(0, ai_sched["running"] - 1)
+    _ai_dispatch()
+
+@asynccontextmanager
+async def ai_work(kind: str, chat_id):
+    """
+    Admission control for AI work. `kind` is "command" (explicit /quiz,
+    /search...), "dm", "ambient" (group mentions/replies) or "background"
+    (pre-generation that no user is waiting on). Yields True once
+    a slot is granted, or False if the request was rejected, shed, or went
+    stale waiting — callers should then skip or answer without the AI.
+    """
+    admitted = await _ai_admit(kind, chat_id)
+    try:
+        yield admitted
+    finally:
+        if admitted:
+            _ai_release()
+
+def ai_sched_summary() -> dict:
+    return {"running": ai_sched["running"], "max_concurrent": AI_MAX_CONCURRENT, "queued": _ai_queue_depth(),
+            "queue_max": AI_QUEUE_MAX, "classes": ai_sched_stats}
+
 async def model_command_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
-    """Owner-only: /model — pick Groq, OpenRouter, or Auto via inline keyboard."""
+    """Owner-only: /model — pick Groq, OpenRouter, Auto or Race via inline keyboard."""
     if not u.message:
         return
     if not is_owner(u.effective_user.id if u.effective_user else 0):
@@ -638,13 +2375,19 @@ async def model_command_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
         return
 
     mode = ai_model_state["mode"]
-    groq_ok = "✅" if not _groq_rate_limited() else "⛔RL"
-    or_ok = "✅" if not _or_rate_limited() else "⛔RL"
+    groq_ok = "✅" if not _groq_rate_limited() else f"⛔RL {ai_rate_state['groq']['blocked_until'] - time.time():.0f}s"
+    or_ok = "✅" if not _or_rate_limited() else f"⛔RL {ai_rate_state['or']['blocked_until'] - time.time():.0f}s"
+
+    st = ai_stream_summary()
+    cs = ai_cache_summary()
+    rl = ai_rate_summary()
+    br = ai_breaker_summary()
 
     kb = InlineKeyboardMarkup([[
         InlineKeyboardButton(f"{'▶' if mode=='gro' else ''} GRO {groq_ok}", callback_data="model:gro"),
         InlineKeyboardButton(f"{'▶' if mode=='rou' else ''} ROU {or_ok}", callback_data="model:rou"),
         InlineKeyboardButton(f"{'▶' if mode=='auto' else ''} AUTO", callback_data="model:auto"),
+        InlineKeyboardButton(f"{'▶' if mode=='race' else ''} RACE", callback_data="model:race"),
     ]])
 
     status = (
@@ -653,8 +2396,17 @@ async def model_command_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
         f"Current: `{mode.upper()}`\n\n"
         f"• *GRO* — Groq `{GROQ_MODEL}` {groq_ok}\n"
         f"• *ROU* — OpenRouter `{OR_MODEL}` {or_ok}\n"
-        f"• *AUTO* — Tries Groq first, falls back to OpenRouter on rate limit\n\n"
-        f"_Rate limit auto-recovers after 60s_"
+        f"• *AUTO* — Tries Groq first, falls back to OpenRouter on rate limit\n"
+        f"• *RACE* — Fires OpenRouter too if Groq is slower than its p{int(AI_HEDGE_PERCENTILE * 100)} "
+        f"(`{_hedge_delay('groq'):.1f}s`), first answer wins\n\n"
+        f"🏁 Races: `{ai_race_stats['races']}` · hedged `{ai_race_stats['hedged']}` · deadline `{AI_DEADLINE:.0f}s`\n"
+        f"🩺 GRO `{br['groq']['state']}` p50 `{_fmt_ms(br['groq']['p50_ms'])}` p95 `{_fmt_ms(br['groq']['p95_ms'])}` err `{br['groq']['error_rate']:.0%}`\n"
+        f"🩺 ROU `{br['or']['state']}` p50 `{_fmt_ms(br['or']['p50_ms'])}` p95 `{_fmt_ms(br['or']['p95_ms'])}` err `{br['or']['error_rate']:.0%}`\n"
+        f"🗃 Cache: `{cs['hits']}` hit / `{cs['misses']}` miss / `{cs['evictions']}` evicted ({cs['size']}/{cs['max']})\n"
+        f"⚡ First text (p50): GRO `{_fmt_ms(st['groq']['ttft_p50_ms'])}` · ROU `{_fmt_ms(st['or']['ttft_p50_ms'])}`\n"
+        f"🚦 Budget: GRO `{rl['groq']['req_avail']}/{rl['groq']['rpm']}` req · `{rl['groq']['tok_avail']}/{rl['groq']['tpm']}` tok"
+        f" | ROU `{rl['or']['req_avail']}/{rl['or']['rpm']}` req · `{rl['or']['tok_avail']}/{rl['or']['tpm']}` tok\n"
+        f"_Rate limits follow Retry-After / x-ratelimit headers (default {AI_RL_DEFAULT_BACKOFF}s)_"
     )
     await u.message.reply_text(status, parse_mode=ParseMode.MARKDOWN, reply_markup=kb)
 
@@ -668,13 +2420,16 @@ async def model_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await q.answer("Owner only!", show_alert=True)
             return
         _, mode = q.data.split(":", 1)
+        if mode not in ("gro", "rou", "auto", "race"):
+            return
         ai_model_state["mode"] = mode
-        label = {"gro": "Groq (GRO)", "rou": "OpenRouter (ROU)", "auto": "Auto Switch"}.get(mode, mode)
+        label = {"gro": "Groq (GRO)", "rou": "OpenRouter (ROU)", "auto": "Auto Switch", "race": "Hedged Race"}.get(mode, mode)
         await q.edit_message_text(
             f"✅ *AI model switched to: {label}*\n\n"
             f"GRO → `{GROQ_MODEL}`\n"
             f"ROU → `{OR_MODEL}`\n"
-            f"AUTO → Groq first, fallback to OpenRouter on rate limit",
+            f"AUTO → Groq first, fallback to OpenRouter on rate limit\n"
+            f"RACE → Groq first, OpenRouter fired in parallel if Groq is slow",
             parse_mode=ParseMode.MARKDOWN
         )
         logger.info(f"[AI] Model mode switched to: {mode}")
@@ -688,10 +2443,15 @@ async def crypto_price_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
         ticker = (c.args[0].upper() if c.args else "BTC")
         cid = u.effective_chat.id
         await safe_react(c.bot, cid, u.message.message_id, "💰")
-        sm = await u.message.reply_text(f"⚡ *Fetching {ticker}/USDT...*", parse_mode=ParseMode.MARKDOWN)
-        loop = asyncio.get_running_loop()
+        snap = await get_ticker_snapshot()
+        td, ts = snap["data"].get(ticker), snap["ts"]
+        sm = None
         try:
-            td = await loop.run_in_executor(None, exchange.fetch_ticker, f"{ticker}/USDT")
+            if td is None:  # not in the snapshot (unknown pair, or no snapshot yet): one live lookup
+                ticker_snapshot_stats["live_fallbacks"] += 1
+                sm = await u.message.reply_text(f"⚡ *Fetching {ticker}/USDT...*", parse_mode=ParseMode.MARKDOWN)
+                td = await single_flight(sf_key("ticker", ticker), lambda: exchange_call("fetch_ticker", f"{ticker}/USDT"))
+                ts = time.time()
             price = td.get('last', 0.0)
             change = td.get('percentage', 0.0)
             vol = td.get('baseVolume', 0.0)
@@ -704,10 +2464,14 @@ async def crypto_price_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
                    f"📈 *24h High*\n`{high:,.4f}`\n\n"
                    f"📉 *24h Low*\n`{low:,.4f}`\n\n"
                    f"🔄 *Volume*\n`{vol:,.2f} {ticker}`\n\n"
-                   f"━━━━━━━━━━━━━━━━━━━━\n🐾 _via Beluga Quant Engine_")
-            await sm.edit_text(res, parse_mode=ParseMode.MARKDOWN)
+                   f"━━━━━━━━━━━━━━━━━━━━\n{_snapshot_age_text(ts)}\n🐾 _via Beluga Quant Engine_")
+            if sm:
+                await sm.edit_text(res, parse_mode=ParseMode.MARKDOWN)
+            else:
+                await u.message.reply_text(res, parse_mode=ParseMode.MARKDOWN)
         except Exception as e:
-            await sm.edit_text(f"😿 Error: `{str(e)[:60]}`")
+            err = f"😿 Error: `{str(e)[:60]}`"
+            await (sm.edit_text(err) if sm else u.message.reply_text(err))
             bot_status["error_count"] += 1
     except Exception as e:
         logger.error(f"[crypto_price] {e}")
@@ -722,39 +2486,215 @@ async def crypto_movers_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
         if not exchange:
             await sm.edit_text("😿 Exchange unavailable right now.")
             return
-        loop = asyncio.get_running_loop()
-        now = time.time()
-        if cache_movers["ts"] and (now - cache_movers["ts"]) < 60:
-            tickers = cache_movers["data"]
-        else:
-            try:
-                tickers = await asyncio.wait_for(loop.run_in_executor(None, exchange.fetch_tickers), timeout=20)
-                cache_movers["ts"] = now
-                cache_movers["data"] = tickers
-            except Exception as e:
-                await sm.edit_text(f"😿 Failed to fetch data: `{str(e)[:60]}`")
-                return
-        records = []
-        for sym, t in tickers.items():
-            if not sym.endswith("/USDT"):
-                continue
-            ch, pr = t.get('percentage'), t.get('last')
-            if ch is None or pr is None:
-                continue
-            records.append({"sym": sym.split("/")[0], "ch": float(ch), "price": float(pr)})
-        if not records:
+        snap = await get_ticker_snapshot()
+        cols = snap["cols"]
+        if cols is None:
+            await sm.edit_text("😿 Failed to fetch data, try again shortly.")
+            return
+        top = rank_tickers(cols, "pct", 5, largest=gainers_mode)
+        if not top.size:
             await sm.edit_text("😿 No data available.")
             return
-        records.sort(key=lambda x: x["ch"], reverse=gainers_mode)
         text = f"📊 *TOP 5 {lbl.upper()} (24H)*\n━━━━━━━━━━━━━━━━━━━━\n\n"
-        for i, r in enumerate(records[:5], 1):
-            s = "🟩 +" if r["ch"] >= 0 else "🟥 "
-            text += f"*{i}. {r['sym']}*\nPrice: `{r['price']:,.4f}` USDT\nChange: `{s}{r['ch']:.2f}%`\n\n"
-        text += "━━━━━━━━━━━━━━━━━━━━\n🐾 _via Beluga Quant Engine_"
+        for i, j in enumerate(top, 1):
+            ch = cols["pct"][j]
+            s = "🟩 +" if ch >= 0 else "🟥 "
+            text += f"*{i}. {cols['sym'][j]}*\nPrice: `{cols['last'][j]:,.4f}` USDT\nChange: `{s}{ch:.2f}%`\n\n"
+        text += f"━━━━━━━━━━━━━━━━━━━━\n{_snapshot_age_text(snap['ts'])}\n🐾 _via Beluga Quant Engine_"
         await sm.edit_text(text, parse_mode=ParseMode.MARKDOWN)
     except Exception as e:
         logger.error(f"[crypto_movers] {e}")
 
+async def screener_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
+    """
+    /screener <gainers|losers|volume|volatility> [QUOTE] [N] — rank the ticker
+    snapshot. /topvolume and /topvolatile are shortcuts. QUOTE defaults to USDT.
+    """
+    if not u.message:
+        return
+    try:
+        cmd = u.message.text.split()[0].lstrip("/").split("@")[0].lower()
+        args = list(c.args or [])
+        kind = {"topvolume": "volume", "topvolatile": "volatility"}.get(cmd)
+        if kind is None:
+            kind = args.pop(0).lower() if args else ""
+        if kind not in SCREENER_KINDS:
+            await u.message.reply_text("🐱 Usage: `/screener gainers|losers|volume|volatility [QUOTE] [N]`", parse_mode=ParseMode.MARKDOWN)
+            return
+        n = next((min(15, max(1, int(a))) for a in args if a.isdigit()), 10)
+        quote = next((a.upper() for a in args if not a.isdigit()), "USDT")
+        if not exchange:
+            await u.message.reply_text("😿 Exchange unavailable right now.")
+            return
+        snap = await get_ticker_snapshot()
+        cols = snap["cols"]
+        top = rank_tickers(cols, SCREENER_KINDS[kind], n, quote=quote, largest=kind != "losers") if cols is not None else []
+        if not len(top):
+            await u.message.reply_text(f"😿 No {quote} pairs with {kind} data right now.")
+            return
+        lines = [f"🔎 *SCREENER · {kind.upper()} · {quote}*", "━━━━━━━━━━━━━━━━━━━━\n"]
+        for i, j in enumerate(top, 1):
+            head = f"*{i}. {cols['sym'][j]}* `{cols['last'][j]:,.4f}`"
+            if kind == "volume":
+                lines.append(f"{head}  Vol `{cols['vol'][j]:,.0f}` {quote}")
+            elif kind == "volatility":
+                lines.append(f"{head}  Range `{cols['range'][j]:.2f}%`")
+            else:
+                lines.append(f"{head}  `{cols['pct'][j]:+.2f}%`")
+        lines += ["\n━━━━━━━━━━━━━━━━━━━━", _snapshot_age_text(snap["ts"]), "🐾 _via Beluga Quant Engine_"]
+        await u.message.reply_text("\n".join(lines), parse_mode=ParseMode.MARKDOWN)
+        bot_status["message_count"] += 1
+    except Exception as e:
+        logger.error(f"[screener] {e}")
+
+OHLCV_WINDOW = int(os.environ.get("OHLCV_WINDOW", "120"))  # candles kept per series
+OHLCV_MIN_REFRESH_SECS = 5
+# (symbol, timeframe) -> {"rows": float64 array (n, 6) of [ts, o, h, l, c, v], "fetched": epoch}.
+# Idle series expire and the series count is capped, which bounds memory at
+# roughly OHLCV_MAX_SERIES * OHLCV_WINDOW * 48 bytes.
+ohlcv_store = BoundedDict("ohlcv", ttl=int(os.environ.get("OHLCV_IDLE_SECS", "1800")),
+                          max_items=int(os.environ.get("OHLCV_MAX_SERIES", "64")))
+ohlcv_stats = {"full_fetches": 0, "incremental_fetches": 0, "fresh_hits": 0, "candles_fetched": 0}
+
+async def get_ohlcv(symbol: str, timeframe: str, limit: int):
+    """
+    Last `limit` candles for (symbol, timeframe) from the rolling store. A
+    cached series only fetches candles from its last timestamp on (that candle
+    is still forming, so it's replaced); a missing or gapped series is fetched
+    whole. Requests within OHLCV_MIN_REFRESH_SECS reuse the series as is.
+    """
+    np = await lazy_import_async("numpy")
+    key = (symbol, timeframe)
+
+    async def _update():
+        entry = ohlcv_store.get(key)
+        now = time.time()
+        if entry is not None and now - entry["fetched"] < OHLCV_MIN_REFRESH_SECS:
+            ohlcv_stats["fresh_hits"] += 1
+            ohlcv_store.touch(key)
+            return entry["rows"]
+        rows = entry["rows"] if entry is not None and len(entry["rows"]) else None
+        tf_ms = exchange.parse_timeframe(timeframe) * 1000
+        if rows is not None and now * 1000 - rows[-1, 0] < tf_ms * OHLCV_WINDOW:
+            fresh = await exchange_call("fetch_ohlcv", symbol, timeframe, since=int(rows[-1, 0]), limit=OHLCV_WINDOW)
+            ohlcv_stats["incremental_fetches"] += 1
+        else:
+            rows = None
+            fresh = await exchange_call("fetch_ohlcv", symbol, timeframe, limit=OHLCV_WINDOW)
+            ohlcv_stats["full_fetches"] += 1
+        fresh = np.asarray(fresh, dtype=np.float64).reshape(-1, 6)
+        ohlcv_stats["candles_fetched"] += len(fresh)
+        if rows is None:
+            rows = fresh
+        elif len(fresh):
+            rows = np.concatenate([rows[rows[:, 0] < fresh[0, 0]], fresh])
+        rows = np.ascontiguousarray(rows[-OHLCV_WINDOW:])
+        ohlcv_store[key] = {"rows": rows, "fetched": now}
+        return rows
+
+    rows = await single_flight(sf_key("ohlcv", symbol, timeframe), _update)
+    return rows[-limit:]
+
+# ── Chart rendering ──────────────────────────────────────────────────────────
+# mplfinance renders run in a small process pool so they don't hold the GIL
+# against the event loop. Workers are forked once at startup (before any other
+# threads exist), import the plotting stack and build the style in their
+# initializer, and stay up. CHART_WORKERS=0 renders in the default thread pool,
+# and so does every render after a worker crash: the pool is never re-forked
+# once other threads may be holding locks.
+CHART_WORKERS = int(os.environ.get("CHART_WORKERS", "1"))
+CHART_CACHE_TTL = int(os.environ.get("CHART_CACHE_TTL", "300"))
+# (symbol, timeframe, last candle ts) -> {"png": bytes, "file_id": str | None}.
+# The last candle is still forming, so entries also expire CHART_CACHE_TTL after
+# rendering. BoundedDict checks that on read, so a hit is never older than that.
+chart_cache = BoundedDict("charts", ttl=CHART_CACHE_TTL, max_items=int(os.environ.get("CHART_CACHE_MAX", "32")))
+chart_stats = {"requests": 0, "cache_hits": 0, "file_id_reuses": 0, "renders": 0, "render_errors": 0,
+               "render_ms_total": 0.0, "last_render_ms": None, "last_wall_ms": None}
+_chart_pool: Optional[ProcessPoolExecutor] = None
+_CHART_STYLE = None  # built once per renderer by _chart_worker_init()
+
+def _chart_worker_init():
+    """Renderer setup: import pandas/mplfinance (Agg) and build the chart style once."""
+    global _CHART_STYLE
+    lazy_import("pandas")
+    mpf = lazy_import("mplfinance")
+    mc = mpf.make_marketcolors(up='#00C48C', down='#ff3366', inherit=True)
+    _CHART_STYLE = mpf.make_mpf_style(base_mpf_style='charles', marketcolors=mc, gridcolor='#222222', facecolor='#0d0d0d')
+
+def _render_chart_png(rows) -> tuple:
+    """Render OHLCV rows (n, 6) to PNG bytes. Runs inside a chart worker; returns (png, render_ms)."""
+    if _CHART_STYLE is None:
+        _chart_worker_init()
+    start = time.perf_counter()
+    pd, mpf = lazy_import("pandas"), lazy_import("mplfinance")
+    df = pd.DataFrame(rows[:, 1:], columns=['Open', 'High', 'Low', 'Close', 'Volume'],
+                      index=pd.DatetimeIndex(pd.to_datetime(rows[:, 0], unit='ms'), name='Timestamp'))
+    buf = io.BytesIO()
+    mpf.plot(df, type='candle', style=_CHART_STYLE, volume=True, savefig=dict(fname=buf, dpi=115, bbox_inches='tight'), figratio=(14,9))
+    return buf.getvalue(), round((time.perf_counter() - start) * 1000, 1)
+
+def start_chart_pool():
+    """Fork the chart workers. Called first thing in main() so no other threads get forked mid-lock."""
+    global _chart_pool
+    if CHART_WORKERS <= 0 or _chart_pool is not None:
+        return
+    try:
+        _chart_pool = ProcessPoolExecutor(max_workers=CHART_WORKERS, mp_context=multiprocessing.get_context("fork"),
+                                          initializer=_chart_worker_init)
+        _chart_pool.submit(time.time)  # fork-context pools start every worker on first submit
+        logger.info(f"[charts] {CHART_WORKERS} render worker(s) started")
+    except Exception as e:
+        _chart_pool = None
+        logger.warning(f"[charts] process pool unavailable, rendering in threads: {e}")
+
+async def close_chart_pool():
+    global _chart_pool
+    if _chart_pool is not None:
+        _chart_pool.shutdown(wait=False, cancel_futures=True)
+        _chart_pool = None
+
+async def get_chart(symbol: str, timeframe: str, rows) -> dict:
+    """
+    Cached chart for the candles in `rows` (at most CHART_CACHE_TTL old),
+    rendering on a miss. Concurrent requests for the same chart share one
+    render. The returned entry's "file_id" is filled in by the caller after
+    the first upload.
+    """
+    key = (symbol, timeframe, int(rows[-1, 0]))
+    chart_stats["requests"] += 1
+    entry = chart_cache.get(key)
+    if entry is not None:
+        chart_stats["cache_hits"] += 1
+        return entry
+
+    async def _render():
+        start = time.perf_counter()
+        try:
+            png, render_ms = await asyncio.get_running_loop().run_in_executor(_chart_pool, _render_chart_png, rows)
+        except BrokenProcessPool:
+            chart_stats["render_errors"] += 1
+            logger.error("[charts] render worker died — rendering in threads from now on")
+            await close_chart_pool()
+            raise
+        except Exception:
+            chart_stats["render_errors"] += 1
+            raise
+        chart_stats["renders"] += 1
+        chart_stats["render_ms_total"] = round(chart_stats["render_ms_total"] + render_ms, 1)
+        chart_stats["last_render_ms"] = render_ms
+        chart_stats["last_wall_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        fresh = {"png": png, "file_id": None}
+        chart_cache[key] = fresh
+        return fresh
+
+    return await single_flight(sf_key("chart", *key), _render)
+
+def chart_summary() -> dict:
+    n, renders = chart_stats["requests"], chart_stats["renders"]
+    return {**chart_stats, "workers": CHART_WORKERS if _chart_pool is not None else 0, "cached": len(chart_cache),
+            "hit_rate": round(chart_stats["cache_hits"] / n, 3) if n else None,
+            "avg_render_ms": round(chart_stats["render_ms_total"] / renders, 1) if renders else None}
+
 async def crypto_chart_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
     if not u.message or not exchange:
         return
@@ -770,23 +2710,25 @@ async def crypto_chart_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
         cid = u.effective_chat.id
         await safe_react(c.bot, cid, u.message.message_id, "📈")
         sm = await u.message.reply_text(f"📊 *Fetching {ticker} ({timeframe})...*", parse_mode=ParseMode.MARKDOWN)
-        loop = asyncio.get_running_loop()
         try:
-            ohlcv = await loop.run_in_executor(None, lambda: exchange.fetch_ohlcv(f"{ticker}/USDT", timeframe, limit=45))
-            if not ohlcv:
+            ohlcv = await get_ohlcv(f"{ticker}/USDT", timeframe, 45)
+            if not len(ohlcv):
                 raise ValueError("Empty dataset")
-            df = pd.DataFrame(ohlcv, columns=['Timestamp', 'Open', 'High', 'Low', 'Close', 'Volume'])
-            df['Timestamp'] = pd.to_datetime(df['Timestamp'], unit='ms')
-            df.set_index('Timestamp', inplace=True)
-            buf = io.BytesIO()
-            mc = mpf.make_marketcolors(up='#00C48C', down='#ff3366', inherit=True)
-            s = mpf.make_mpf_style(base_mpf_style='charles', marketcolors=mc, gridcolor='#222222', facecolor='#0d0d0d')
-            def _plot():
-                mpf.plot(df, type='candle', style=s, volume=True, savefig=dict(fname=buf, dpi=115, bbox_inches='tight'), figratio=(14,9))
-            await loop.run_in_executor(None, _plot)
-            buf.seek(0)
+            chart = await get_chart(f"{ticker}/USDT", timeframe, ohlcv)
             await sm.delete()
-            await u.message.reply_photo(photo=buf, caption=f"📊 *{ticker}/USDT* • `{timeframe}`\n🐾 _Rendered via Beluga._", parse_mode=ParseMode.MARKDOWN)
+            caption = f"📊 *{ticker}/USDT* • `{timeframe}`\n🐾 _Rendered via Beluga._"
+            msg = None
+            if chart["file_id"]:
+                try:
+                    msg = await u.message.reply_photo(photo=chart["file_id"], caption=caption, parse_mode=ParseMode.MARKDOWN)
+                    chart_stats["file_id_reuses"] += 1
+                except BadRequest as e:
+                    logger.warning(f"[charts] cached file_id rejected, re-uploading: {e}")
+                    chart["file_id"] = None
+            if msg is None:
+                msg = await u.message.reply_photo(photo=io.BytesIO(chart["png"]), caption=caption, parse_mode=ParseMode.MARKDOWN)
+                if msg.photo:
+                    chart["file_id"] = msg.photo[-1].file_id
         except Exception as e:
             await sm.edit_text(f"😿 Error: `{str(e)[:60]}`")
     except Exception as e:
@@ -801,7 +2743,7 @@ def fetch_google_news(feed_type: str) -> list:
     url = feeds.get(feed_type, feeds["tech"])
     results = []
     try:
-        parsed = feedparser.parse(url)
+        parsed = lazy_import("feedparser").parse(url)
         for entry in parsed.entries[:20]:
             title = entry.get("title", "").strip()
             title = re.sub(r'\s*-\s*[^-]{3,40}$', '', title).strip()
@@ -852,12 +2794,11 @@ async def execute_news_flow(u: Update, c: ContextTypes.DEFAULT_TYPE, feed_type:
         cid = u.effective_chat.id
         await safe_react(c.bot, cid, u.message.message_id, "📰")
         sm = await u.message.reply_text(f"🛰 *Fetching {label}...*", parse_mode=ParseMode.MARKDOWN)
-        loop = asyncio.get_running_loop()
         now = time.time()
         if news_cache[feed_type]["ts"] and (now - news_cache[feed_type]["ts"]) < 300:
             items = news_cache[feed_type]["data"]
         else:
-            items = await loop.run_in_executor(None, fetch_google_news, feed_type)
+            items = await single_flight_executor(sf_key("news", feed_type), fetch_google_news, feed_type)
             news_cache[feed_type]["ts"] = now
             news_cache[feed_type]["data"] = items
         if not items:
@@ -896,7 +2837,7 @@ async def qr_generate_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
         sm = await u.message.reply_text("🟩 *Generating QR Code...*", parse_mode=ParseMode.MARKDOWN)
         loop = asyncio.get_running_loop()
         def _build():
-            qr = qrcode.QRCode(version=1, box_size=10, border=4)
+            qr = lazy_import("qrcode").QRCode(version=1, box_size=10, border=4)
             qr.add_data(payload)
             qr.make(fit=True)
             return qr.make_image(fill_color="black", back_color="white")
@@ -922,6 +2863,7 @@ async def qr_scan_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
         buf.seek(0)
         loop = asyncio.get_running_loop()
         def _decode():
+            np, cv2 = lazy_import("numpy"), lazy_import("cv2")
             arr = np.frombuffer(buf.getvalue(), dtype=np.uint8)
             img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
             detector = cv2.QRCodeDetector()
@@ -947,6 +2889,7 @@ async def img_handler(u: Update, c: ContextTypes.DEFAULT_TYPE, action: str):
         await f.download_to_memory(b)
         b.seek(0)
         loop = asyncio.get_running_loop()
+        Image = await lazy_import_async("PIL.Image")
         if action == "info":
             im = Image.open(b)
             await sm.edit_text(
@@ -997,6 +2940,7 @@ def _wrap_text(draw, text: str, font, max_width: int) -> list:
     return lines if lines else [text]
 
 def _apply_watermark(buf: io.BytesIO, wm_text: str, font_size: int, color_key: str, style_name: str) -> io.BytesIO:
+    Image, ImageDraw = lazy_import("PIL.Image"), lazy_import("PIL.ImageDraw")
     im = Image.open(buf).convert("RGBA")
     img_w, img_h = im.size
     rgba = VIBGYOR_COLORS.get(color_key, (255, 255, 255, 220))
@@ -1147,34 +3091,167 @@ def quiz_on_cooldown(cid: str, question: str) -> bool:
     return time.time() < quiz_cooldown.get(cid, {}).get(q_hash(question), 0)
 
 def mark_quiz(cid: str, question: str):
-    quiz_cooldown.setdefault(cid, {})[q_hash(question)] = time.time() + 3600
+    quiz_cooldown.setdefault(cid, BoundedDict(ttl=3600))[q_hash(question)] = time.time() + 3600
+
+def _validate_quiz(d) -> Optional[dict]:
+    """Normalise one model-produced question dict, or None if it isn't a usable 4-option MCQ."""
+    try:
+        q = str(d.get("question", "")).strip()
+        opts = [str(o).strip() for o in d.get("options", [])]
+        idx = int(d.get("correct_index", 0))
+        fact = str(d.get("fun_fact", "Meow!")).strip() or "Meow!"
+    except Exception:
+        return None
+    if not q or len(opts) != 4 or not all(opts) or len(set(o.lower() for o in opts)) != 4 or not (0 <= idx <= 3):
+        return None
+    return {"question": q, "options": opts, "correct_index": idx, "fun_fact": fact}
 
 async def gen_quiz(topic: str, cid: str) -> Optional[dict]:
-    for _ in range(2):
+    system = "Trivia master. Output ONLY raw JSON, no markdown."
+    prompt = (f"Topic: '{topic}'. Generate 1 MC question.\n"
+              '{"question":"...","options":["A","B","C","D"],"correct_index":0,"fun_fact":"..."}')
+    # Only validated questions are cached (as JSON), so a malformed reply is
+    # never served again. The cached one may come from another chat; if it is
+    # on this chat's cooldown we go to the provider instead.
+    key = _ai_cache_key(system, prompt, 200, "quiz")
+    hit = _ai_cache_get(key)
+    if hit is not None:
+        qd = json.loads(hit)
+        if not quiz_on_cooldown(cid, qd["question"]):
+            return qd
+    for attempt in range(2):
         try:
-            raw = await ai("Trivia master. Output ONLY raw JSON, no markdown.",
-                           f"Topic: '{topic}'. Generate 1 MC question.\n"
-                           '{"question":"...","options":["A","B","C","D"],"correct_index":0,"fun_fact":"..."}',
-                           "", max_tok=200)
+            raw = await ai(system, prompt, "", max_tok=200)
             if not raw:
                 continue
             m = re.search(r"\{[\s\S]+\}", raw)
             if not m:
                 continue
-            d = json.loads(m.group(0))
-            q = str(d.get("question", "")).strip()
-            opts = d.get("options", [])
-            idx = int(d.get("correct_index", 0))
-            fact = str(d.get("fun_fact", "Meow!")).strip()
-            if not q or len(opts) != 4 or not (0 <= idx <= 3):
+            qd = _validate_quiz(json.loads(m.group(0)))
+            if not qd:
                 continue
-            if quiz_on_cooldown(cid, q):
+            _ai_cache_put(key, json.dumps(qd), AI_CACHE_TTL_QUIZ)
+            if quiz_on_cooldown(cid, qd["question"]):
                 continue
-            return {"question": q, "options": opts, "correct_index": idx, "fun_fact": fact}
+            return qd
         except Exception:
             pass
     return None
 
+QUIZ_POOL_TARGET = 6       # questions kept ready per topic
+QUIZ_POOL_LOW = 2          # refill in the background once a pool drops to this
+QUIZ_BATCH_SIZE = 4        # questions requested per AI call
+QUIZ_TOKENS_PER_QUESTION = 300  # the model's reasoning tokens count against max_tok too
+QUIZ_POOL_MAX_TOPICS = 30  # custom topics beyond QUIZ_TOPICS are LRU-evicted past this
+QUIZ_POOL_REFILL_EVERY = 300
+QUIZ_DEMAND_TTL = 6 * 3600  # the refiller only tops up topics /quiz asked for within this window
+
+quiz_pool: OrderedDict = OrderedDict()  # topic key -> deque of validated question dicts
+quiz_pool_stats = {"served_from_pool": 0, "pool_misses": 0, "batches": 0, "generated": 0, "rejected": 0}
+quiz_demand = BoundedDict("quiz_demand", ttl=QUIZ_DEMAND_TTL, max_items=QUIZ_POOL_MAX_TOPICS)  # topic key -> topic
+
+def _quiz_topic_key(topic: str) -> str:
+    return re.sub(r"\s+", " ", topic).strip().lower()[:60]
+
+_QUIZ_TOPIC_KEYS = {_quiz_topic_key(t) for t in QUIZ_TOPICS}
+
+def _recent_quiz_hashes() -> set:
+    now = time.time()
+    return {h for per_chat in quiz_cooldown.values() for h, until in per_chat.items() if until > now}
+
+def _parse_quiz_batch(raw: str) -> list:
+    """Pull question dicts out of a batch reply: a JSON array if possible, else every flat {...} object."""
+    m = re.search(r"\[[\s\S]+\]", raw or "")
+    if m:
+        try:
+            items = json.loads(m.group(0))
+            if isinstance(items, list):
+                return [d for d in items if isinstance(d, dict)]
+        except Exception:
+            pass
+    out = []
+    for obj in re.findall(r"\{[^{}]+\}", raw or ""):
+        try:
+            out.append(json.loads(obj))
+        except Exception:
+            continue
+    return out
+
+async def gen_quiz_batch(topic: str, n: int = QUIZ_BATCH_SIZE) -> list:
+    """One AI call for up to `n` questions, validated and de-duplicated against recent cooldowns."""
+    raw = await ai("Trivia master. Output ONLY raw JSON, no markdown.",
+                   f"Topic: '{topic}'. Generate {n} different MC questions as a JSON array.\n"
+                   '[{"question":"...","options":["A","B","C","D"],"correct_index":0,"fun_fact":"..."}, ...]',
+                   "", max_tok=min(2000, QUIZ_TOKENS_PER_QUESTION * n))
+    quiz_pool_stats["batches"] += 1
+    seen = _recent_quiz_hashes() | {q_hash(q["question"]) for q in quiz_pool.get(_quiz_topic_key(topic), [])}
+    out = []
+    for d in _parse_quiz_batch(raw):
+        qd = _validate_quiz(d)
+        if not qd or q_hash(qd["question"]) in seen:
+            quiz_pool_stats["rejected"] += 1
+            continue
+        seen.add(q_hash(qd["question"]))
+        out.append(qd)
+    quiz_pool_stats["generated"] += len(out)
+    return out
+
+async def _fill_quiz_pool(topic: str):
+    key = _quiz_topic_key(topic)
+    pool = quiz_pool.get(key)
+    if pool is not None and len(pool) >= QUIZ_POOL_TARGET:
+        return
+    async with ai_work("background", "_quiz_pool") as admitted:
+        if not admitted:
+            return
+        batch = await gen_quiz_batch(topic)
+    pool = quiz_pool.setdefault(key, deque())
+    quiz_pool.move_to_end(key)
+    pool.extend(batch[:max(0, QUIZ_POOL_TARGET - len(pool))])
+    while len(quiz_pool) > QUIZ_POOL_MAX_TOPICS:
+        custom = [k for k in quiz_pool if k not in _QUIZ_TOPIC_KEYS]
+        del quiz_pool[custom[0] if custom else next(iter(quiz_pool))]
+
+async def _refill_quiz_topic(topic: str):
+    """Top up one topic's pool; concurrent triggers for the same topic collapse into one batch."""
+    try:
+        await single_flight(sf_key("quizpool", _quiz_topic_key(topic)), lambda: _fill_quiz_pool(topic))
+    except Exception as e:
+        logger.warning(f"[quiz_pool] refill {topic} failed: {e}")
+
+def schedule_quiz_refill(topic: str):
+    spawn_background(_refill_quiz_topic(topic))
+
+def take_pooled_quiz(topic: str, cid: str) -> Optional[dict]:
+    """Pop a ready question for this chat (skipping ones on its cooldown) and top the pool up if it runs low."""
+    key = _quiz_topic_key(topic)
+    quiz_demand[key] = topic
+    pool = quiz_pool.get(key)
+    qd = None
+    if pool:
+        quiz_pool.move_to_end(key)
+        for _ in range(len(pool)):
+            cand = pool.popleft()
+            if not quiz_on_cooldown(cid, cand["question"]):
+                qd = cand
+                break
+            pool.append(cand)  # still fresh for other chats
+    if qd:
+        quiz_pool_stats["served_from_pool"] += 1
+    else:
+        quiz_pool_stats["pool_misses"] += 1
+    if pool is None or len(pool) <= QUIZ_POOL_LOW:
+        schedule_quiz_refill(topic)
+    return qd
+
+async def quiz_pool_refiller():
+    """Background loop keeping the pools of recently requested topics topped up,
+    one batch call at a time. Topics nobody has asked for cost no AI quota."""
+    while True:
+        await asyncio.sleep(QUIZ_POOL_REFILL_EVERY)
+        for topic in list(quiz_demand.values()):
+            await _refill_quiz_topic(topic)
+
 async def quiz_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
     if not u.message:
         return
@@ -1183,12 +3260,15 @@ async def quiz_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
         topic = (parts[1].strip() if len(parts) > 1 else None) or random.choice(QUIZ_TOPICS)
         cid, cid_i = str(u.effective_chat.id), u.effective_chat.id
         await safe_react(c.bot, cid_i, u.message.message_id, "💡")
-        sm = await u.message.reply_text("🎲 *Generating quiz...*", parse_mode=ParseMode.MARKDOWN)
-        qdata = await gen_quiz(topic, cid)
-        try:
-            await sm.delete()
-        except Exception:
-            pass
+        qdata = take_pooled_quiz(topic, cid)
+        if not qdata:
+            sm = await u.message.reply_text("🎲 *Generating quiz...*", parse_mode=ParseMode.MARKDOWN)
+            async with ai_work("command", cid) as admitted:
+                qdata = await gen_quiz(topic, cid) if admitted else None
+            try:
+                await sm.delete()
+            except Exception:
+                pass
         if qdata:
             mark_quiz(cid, qdata["question"])
             try:
@@ -1222,8 +3302,7 @@ async def poll_answer_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
             return
         cid, uid = str(info["chat_id"]), str(ans.user.id)
         name = (ans.user.first_name or "?")[:30]
-        bump_score(cid, uid, name, +10)
-        await sync_leaderboard_chat_to_mongo(cid)
+        await bump_score(cid, uid, name, +10)
     except Exception:
         pass
 
@@ -1232,12 +3311,10 @@ async def lb_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
         return
     try:
         cid = str(u.effective_chat.id)
-        local_scores = db.get("scores", {}).get(cid, {})
-        lb = sorted(local_scores.values(), key=lambda x: x.get("score", 0), reverse=True)
-        seen_ids = set()
-        clean_lb = [e for e in lb if e.get("user_id") not in seen_ids and not seen_ids.add(e.get("user_id"))]
+        clean_lb = await top_scores(cid, 10)
+        my_rank, my_entry = (await score_rank(cid, str(u.effective_user.id))) if u.effective_user else (None, None)
 
-        lw = db.get("weekly", {}).get(cid, {})
+        lw = await get_weekly(cid)
         lines = []
         if lw and lw.get("top3"):
             lines.append("🏆 *LAST WEEK CHAMPIONS* 🏆\n")
@@ -1251,6 +3328,8 @@ async def lb_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
             for i, e in enumerate(clean_lb[:10]):
                 m = MEDALS[i] if i < len(MEDALS) else f"{i+1}."
                 lines.append(f"{m} `{e.get('name','Unknown')[:18]:<18}` `{e.get('score',0):>6,} pts`")
+            if my_rank and my_rank > 10:
+                lines.append(f"\n👤 You: #{my_rank} — {my_entry.get('score', 0):,} pts")
         lines += ["\n━━━━━━━━━━━━━━━━━━━━", "➕ +10 quiz/ttt  ·  +700 mine  ·  +50 gm"]
         text = "\n".join(lines)
 
@@ -1265,10 +3344,10 @@ async def lb_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
 async def nw_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
     """
     New Week reset:
-    1. Read CURRENT in-memory scores for this chat.
-    2. Compute top 3 -> store as this chat's "weekly" champions (kept, not reset).
+    1. Read this chat's top 3 from its hydrated state.
+    2. Store them as this chat's "weekly" champions (kept, not reset).
     3. Wipe this chat's scores.
-    4. Push both changes to MongoDB immediately.
+    4. Push both changes to storage immediately.
     """
     if not u.message:
         return
@@ -1277,15 +3356,12 @@ async def nw_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
             await u.message.reply_text("🚫 Owner only.")
             return
         cid = str(u.effective_chat.id)
-        lb = sorted(db.get("scores", {}).get(cid, {}).values(), key=lambda x: x.get("score", 0), reverse=True)
-        seen_ids = set()
-        clean_lb = [e for e in lb if e.get("user_id") not in seen_ids and not seen_ids.add(e.get("user_id"))]
-        top3 = [{"name": e.get("name", "?"), "score": e.get("score", 0)} for e in clean_lb[:3]]
+        top3 = [{"name": e.get("name", "?"), "score": e.get("score", 0)} for e in await top_scores(cid, 3)]
         wk_label = datetime.now().strftime("%d %b %Y")
-        db.setdefault("weekly", {})[cid] = {"top3": top3, "week_label": wk_label}
-        db["scores"][cid] = {}
-        await sync_weekly_to_mongo(cid)
-        await sync_leaderboard_chat_to_mongo(cid)
+        weekly = {"top3": top3, "week_label": wk_label}
+        weekly_cache[cid] = weekly
+        await sync_weekly_to_mongo(cid, weekly)
+        await reset_chat_scores(cid)
 
         announce = ["🏆🎉 *NEW WEEK!* 🎉🏆", f"\n_Week: {wk_label}_\n", "👑 *Champions:*\n"]
         announce.extend([f"{MEDALS[i]} *{e['name']}* — {e['score']:,} pts" for i, e in enumerate(top3)])
@@ -1313,8 +3389,7 @@ async def pump_dump_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
         cmd = parts[0].lstrip("/").lower().split("@")[0]
         delta = +amount if cmd == "pump" else -amount
         target, cid = u.message.reply_to_message.from_user, str(u.effective_chat.id)
-        new_sc = bump_score(cid, str(target.id), (target.first_name or "User")[:30], delta)
-        await sync_leaderboard_chat_to_mongo(cid)
+        new_sc = await bump_score(cid, str(target.id), (target.first_name or "User")[:30], delta)
         emoji = "🚀" if cmd == "pump" else "📉"
         sign = "+" if delta > 0 else ""
         await u.message.reply_text(
@@ -1329,9 +3404,8 @@ async def fun_dispatcher(u: Update, c: ContextTypes.DEFAULT_TYPE):
         return
     try:
         cid = str(u.effective_chat.id)
-        db.setdefault("seen", {}).setdefault(cid, {})
         cmd = u.message.text.lower().split()[0].lstrip("/").split("@")[0]
-        active_users = list(db.get("seen", {}).get(cid, {}).values())
+        active_users = list(db["seen"].get(cid, {}).values())
         if len(active_users) < (2 if cmd == "couple" else 1) and OWNER_ID:
             active_users.append({"id": OWNER_ID, "un": "Owner", "n": "Owner"})
         if len(active_users) < (2 if cmd == "couple" else 1):
@@ -1340,7 +3414,7 @@ async def fun_dispatcher(u: Update, c: ContextTypes.DEFAULT_TYPE):
         day = datetime.now().strftime("%y-%m-%d")
         lk = f"{cid}:{cmd}:{day}"
         async with fun_cache_lock:
-            cached = fun_db.get("gay_couple_log", {}).get(lk)
+            cached = fun_db["gay_couple_log"].get(lk)
             if cached and cached.get("date") == day:
                 await u.message.reply_text(cached["result"], parse_mode=ParseMode.MARKDOWN)
                 return
@@ -1350,7 +3424,7 @@ async def fun_dispatcher(u: Update, c: ContextTypes.DEFAULT_TYPE):
         else:
             m = [random.choice(active_users)]
             res = f"🌈 *{m[0]['n']}* is today's rainbow! 🌈"
-        fun_db.setdefault("gay_couple_log", {})[lk] = {"date": day, "result": res, "users": [p.get("id") for p in m]}
+        fun_db["gay_couple_log"][lk] = {"date": day, "result": res, "users": [p.get("id") for p in m]}
         await u.message.reply_text(res, parse_mode=ParseMode.MARKDOWN)
     except Exception as e:
         logger.error(f"[fun_dispatcher] {e}")
@@ -1412,8 +3486,7 @@ async def gm_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             utime = datetime.now().strftime("%H:%M")
             users.append({"id": user_id, "name": u_name, "time": utime})
             gm_tracker[cid] = (msg_id, users, date_str)
-            bump_score(str(q.message.chat_id), user_id, u_name, +50)
-            await sync_leaderboard_chat_to_mongo(str(q.message.chat_id))
+            await bump_score(str(q.message.chat_id), user_id, u_name, +50)
             try:
                 new_cap = _build_gm_caption(users, date_str)
                 kb = InlineKeyboardMarkup([[InlineKeyboardButton("GM 🥱", callback_data=f"gm:attend:{cid}")]])
@@ -1499,8 +3572,9 @@ def ttt_build_text(g):
     return f"🎮 *TIC TAC TOE*\n━━━━━━━━━━━━━━\n❌ {g['x_name']}  🆚  ⭕ {g['o_name']}\n━━━━━━━━━━━━━━\n\n{board_str}\n\n━━━━━━━━━━━━━━\n{sl}"
 
 async def cleanup_expired_games():
+    """The one background sweeper: stale games plus every BoundedDict's TTL expiry."""
     while True:
-        await asyncio.sleep(60)
+        await asyncio.sleep(BOUNDED_SWEEP_SECS)
         now = time.time()
         for gkey in list(ttt_games.keys()):
             g = ttt_games[gkey]
@@ -1509,6 +3583,17 @@ async def cleanup_expired_games():
                     user_in_game.pop(uid, None)
                 game_timers.pop(gkey, None)
                 del ttt_games[gkey]
+        for gkey in list(mine_games.keys()):
+            g = mine_games[gkey]
+            if g.get("status") == "setting" and now - g.get("created", now) > MINE_SETUP_TTL:
+                del mine_games[gkey]
+        mono = time.monotonic()
+        for name, d in list(bounded_registry.items()):
+            try:
+                d.sweep(mono)
+            except Exception as e:
+                logger.error(f"[sweeper] {name}: {e}")
+        refresh_bounded_stats()
 
 async def run_game_timer(c, gkey):
     try:
@@ -1606,8 +3691,7 @@ async def ttt_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             g["status"], g["winner_name"] = "win", (g["x_name"] if ws == TTT_X else g["o_name"])
             winner_uid = str(g["x_id"]) if ws == TTT_X else str(g["o_id"] if not g["vs_bot"] else -1)
             if winner_uid and winner_uid != "-1":
-                bump_score(str(cid), winner_uid, g["winner_name"], +10)
-                await sync_leaderboard_chat_to_mongo(str(cid))
+                await bump_score(str(cid), winner_uid, g["winner_name"], +10)
             try: await q.edit_message_text(ttt_build_text(g), parse_mode=ParseMode.MARKDOWN, reply_markup=ttt_build_keyboard(board, disabled=True))
             except Exception: pass
             for uid in [str(g["x_id"]), str(g["o_id"])]: user_in_game.pop(uid, None)
@@ -1679,10 +3763,11 @@ async def mine_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
         m_stat["plays"] += 1
         if m_stat["plays"] > 20:
             m_stat["block_until"] = now + 3600; m_stat["plays"] = 0
+            mine_play_stats.touch(uid)  # the block must outlive the entry's TTL
             await u.message.reply_text("🛑 *Limit Hit!*\n1-hour break.", parse_mode=ParseMode.MARKDOWN); return
         gkey = f"{cid}_{uid}_{int(now)}"
         mine_games[gkey] = {"uid": uid, "name": (u.effective_user.first_name or "Player")[:20], "bombs": 0,
-                             "state": [], "revealed": [False]*6, "chat_id": u.effective_chat.id, "msg_id": None, "status": "setting"}
+                             "state": [], "revealed": [False]*6, "chat_id": u.effective_chat.id, "msg_id": None, "status": "setting", "created": now}
         msg = await u.message.reply_photo(photo=MINE_IMAGE_URL, caption="💣 *MINESWEEPER*\n\nChoose number of mines:", parse_mode=ParseMode.MARKDOWN, reply_markup=_mine_setup_keyboard(gkey))
         mine_games[gkey]["msg_id"] = msg.message_id
     except Exception as e:
@@ -1701,8 +3786,7 @@ async def run_mine_timer(c, gkey):
                 return
             if td["remaining"] <= 0:
                 g["status"] = "timeout"
-                new_sc = bump_score(str(cid), g["uid"], g["name"], -5)
-                await sync_leaderboard_chat_to_mongo(str(cid))
+                new_sc = await bump_score(str(cid), g["uid"], g["name"], -5)
                 try:
                     await c.bot.edit_message_caption(chat_id=cid, message_id=msg_id, caption=mine_build_text(g, 0) + f"\n\nBalance: *{new_sc:,} pts*", parse_mode=ParseMode.MARKDOWN, reply_markup=_mine_board_keyboard(gkey, g["state"], g["revealed"], disabled=True))
                 except Exception:
@@ -1750,8 +3834,7 @@ async def mine_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if is_bomb:
                 g["status"] = "lost"
                 mine_timers.pop(gkey, None)
-                new_sc = bump_score(cid, g["uid"], g["name"], -5)
-                await sync_leaderboard_chat_to_mongo(cid)
+                new_sc = await bump_score(cid, g["uid"], g["name"], -5)
                 try: await q.edit_message_caption(caption=mine_build_text(g, 0) + f"\n\nBalance: *{new_sc:,} pts*", parse_mode=ParseMode.MARKDOWN, reply_markup=_mine_board_keyboard(gkey, g["state"], g["revealed"], disabled=True))
                 except Exception: pass
                 mine_games.pop(gkey, None)
@@ -1764,8 +3847,7 @@ async def mine_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 if opened_count >= total_safe:
                     g["status"] = "won"
                     mine_timers.pop(gkey, None)
-                    new_sc = bump_score(cid, g["uid"], g["name"], +700)
-                    await sync_leaderboard_chat_to_mongo(cid)
+                    new_sc = await bump_score(cid, g["uid"], g["name"], +700)
                     try: await q.edit_message_caption(caption=mine_build_text(g, 0) + f"\n\nBalance: *{new_sc:,} pts*", parse_mode=ParseMode.MARKDOWN, reply_markup=_mine_board_keyboard(gkey, g["state"], g["revealed"], disabled=True))
                     except Exception: pass
                     mine_games.pop(gkey, None)
@@ -1869,7 +3951,8 @@ async def web_summarise(query, wiki, goog, system_prompt, max_tok=500):
     if wiki["found"]: ctx.append(f"Wikipedia ({wiki['title']}):\n{wiki['intro']}")
     if not ctx:
         return ""
-    return await ai(system_prompt, f"User question: {query}\n\nSearch facts:\n{chr(10).join(ctx)[:3000]}\n\nAnswer concisely.", "", max_tok=max_tok)
+    return await ai(system_prompt, f"User question: {query}\n\nSearch facts:\n{chr(10).join(ctx)[:3000]}\n\nAnswer concisely.", "", max_tok=max_tok,
+                    cache_ttl=AI_CACHE_TTL_SEARCH)
 
 def wiki_page_image(title: str) -> Optional[str]:
     """
@@ -1933,31 +4016,33 @@ async def _run_search_and_reply(u: Update, c: ContextTypes.DEFAULT_TYPE, query:
     await safe_react(c.bot, cid, u.message.message_id, "🔍")
     sm = await u.message.reply_text("🔎 *Searching...*", parse_mode=ParseMode.MARKDOWN)
 
-    loop = asyncio.get_running_loop()
     wiki, goog = await asyncio.gather(
-        loop.run_in_executor(None, wiki_summary, query),
-        loop.run_in_executor(None, google_search, query),
+        single_flight_executor(sf_key("wiki", query), wiki_summary, query),
+        single_flight_executor(sf_key("google", query), google_search, query),
     )
 
     image_url = wiki.get("image")
     if not image_url and wiki.get("found") and wiki.get("title"):
         try:
-            image_url = await loop.run_in_executor(None, wiki_page_image, wiki["title"])
+            image_url = await single_flight_executor(sf_key("wikiimg", wiki["title"]), wiki_page_image, wiki["title"])
         except Exception:
             image_url = None
     if not image_url:
         try:
-            image_url = await loop.run_in_executor(None, google_image_search, query)
+            image_url = await single_flight_executor(sf_key("gimg", query), google_image_search, query)
         except Exception:
             image_url = None
 
-    summary = await web_summarise(
-        query, wiki, goog,
-        "Smart research assistant. Read the given facts and write ONE tight summary "
-        "in 60 to 100 words total, in clear natural English. No headers, no bullet points, "
-        "just flowing prose that directly answers what the person was searching for.",
-        max_tok=180,
-    )
+    summary = ""
+    async with ai_work("command", cid) as admitted:
+        if admitted:
+            summary = await web_summarise(
+                query, wiki, goog,
+                "Smart research assistant. Read the given facts and write ONE tight summary "
+                "in 60 to 100 words total, in clear natural English. No headers, no bullet points, "
+                "just flowing prose that directly answers what the person was searching for.",
+                max_tok=180,
+            )
 
     if not summary and wiki.get("intro"):
         summary = wiki["intro"][:600]
@@ -2008,8 +4093,7 @@ async def ss_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
     query = parts[1].strip()
     cid = u.effective_chat.id
     sm = await u.message.reply_text("🖼 *Finding image...*", parse_mode=ParseMode.MARKDOWN)
-    loop = asyncio.get_running_loop()
-    image_url = await loop.run_in_executor(None, google_image_search, query)
+    image_url = await single_flight_executor(sf_key("gimg", query), google_image_search, query)
     try:
         await sm.delete()
     except Exception:
@@ -2023,7 +4107,7 @@ async def ss_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
 
 
 SEARCH_LIMIT_PER_USER = 4
-_search_usage: dict = {}  # {user_id: [timestamp, timestamp, ...]}
+_search_usage = BoundedDict("search_usage", ttl=86400, max_items=50000)  # {user_id: [timestamp, timestamp, ...]}
 
 def _search_quota_remaining(user_id) -> int:
     """Returns how many searches this user has left in the current rolling 24h window."""
@@ -2071,9 +4155,12 @@ async def bananalogic_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
     cid = u.effective_chat.id
     await safe_react(c.bot, cid, u.message.message_id, "🍌")
     sm = await u.message.reply_text("🍌 *BananaLogic searching...*", parse_mode=ParseMode.MARKDOWN)
-    loop = asyncio.get_running_loop()
-    wiki, goog = await asyncio.gather(loop.run_in_executor(None, wiki_summary, query), loop.run_in_executor(None, google_search, query))
-    answer = await web_summarise(query, wiki, goog, BANANA_PROMPT, max_tok=600)
+    wiki, goog = await asyncio.gather(single_flight_executor(sf_key("wiki", query), wiki_summary, query),
+                                      single_flight_executor(sf_key("google", query), google_search, query))
+    answer = ""
+    async with ai_work("command", cid) as admitted:
+        if admitted:
+            answer = await web_summarise(query, wiki, goog, BANANA_PROMPT, max_tok=600)
 
     if not answer:
         try:
@@ -2086,7 +4173,7 @@ async def bananalogic_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
     image_url = None
     if wiki.get("found") and wiki.get("title"):
         try:
-            image_url = await loop.run_in_executor(None, wiki_page_image, wiki["title"])
+            image_url = await single_flight_executor(sf_key("wikiimg", wiki["title"]), wiki_page_image, wiki["title"])
         except Exception:
             image_url = None
 
@@ -2310,12 +4397,12 @@ async def monitor_private_chat(u: Update, c: ContextTypes.DEFAULT_TYPE):
         mem_ctx = build_memory_context(memory)
         hist_ctx = build_chat_history_context(memory)
         system = f"{CHAT_PROMPT}\nThe user's name is {user_name}.{mem_ctx}{hist_ctx}"
-        reply = await ai(system, text, f"Hey {user_name}! 🐾", max_tok=140)
-
-        try:
-            await u.message.reply_text(reply, reply_to_message_id=u.message.message_id)
-        except Exception:
-            pass
+        async with ai_work("dm", u.effective_chat.id) as admitted:
+            if not admitted:
+                await u.message.reply_text("😿 I'm a little swamped right now — try me again in a moment!",
+                                           reply_to_message_id=u.message.message_id)
+                return
+            reply = await ai_stream_reply(u.message, system, text, f"Hey {user_name}! 🐾", max_tok=140)
 
         await append_chat_history(uid, text, reply)
 
@@ -2357,13 +4444,15 @@ async def monitor_ghost_mode(u: Update, c: ContextTypes.DEFAULT_TYPE):
         mem_ctx = build_memory_context(memory)
         hist_ctx = build_chat_history_context(memory)
         system = f"{CHAT_PROMPT}\nThe user's name is {user_name}.{mem_ctx}{hist_ctx}"
-        reply = await ai(system, msg_content, f"Hey {user_name}! 🐾", max_tok=140)
-        await u.message.reply_text(reply, reply_to_message_id=u.message.message_id)
+        async with ai_work("ambient", u.effective_chat.id) as admitted:
+            if not admitted:
+                return
+            reply = await ai_stream_reply(u.message, system, msg_content, f"Hey {user_name}! 🐾", max_tok=140)
         await append_chat_history(uid, msg_content, reply)
     except Exception as e:
         logger.error(f"[monitor_ghost_mode] {e}")
 
-ai_reply_counter = {}
+ai_reply_counter = BoundedDict("ai_reply_counter", ttl=86400, max_items=20000)
 
 async def monitor_group(u: Update, c: ContextTypes.DEFAULT_TYPE):
     if not u.message or not u.effective_user or u.effective_user.is_bot:
@@ -2390,10 +4479,10 @@ async def monitor_group(u: Update, c: ContextTypes.DEFAULT_TYPE):
             except Exception: pass
             return
 
-        db.setdefault("seen", {}).setdefault(cid, {})[str(uid)] = {
-            "id": uid, "un": u.effective_user.username, "n": u.effective_user.first_name or "User"
-        }
-        counts = db.setdefault("counts", {})
+        seen = db["seen"].setdefault(cid, BoundedDict(max_items=SEEN_PER_CHAT_MAX))
+        seen[str(uid)] = {"id": uid, "un": u.effective_user.username, "n": u.effective_user.first_name or "User"}
+        db["seen"].touch(cid)
+        counts = db["counts"]
         counts[cid] = counts.get(cid, 0) + 1
 
         if counts[cid] % 14 == 0:
@@ -2439,21 +4528,26 @@ async def monitor_group(u: Update, c: ContextTypes.DEFAULT_TYPE):
             try: await asyncio.wait_for(c.bot.send_chat_action(u.effective_chat.id, "typing"), timeout=4.0)
             except Exception: pass
 
-            emoji = await ai_emoji(text)
-            try: await safe_react(c.bot, u.effective_chat.id, u.message.message_id, emoji)
-            except Exception: pass
+            on_reaction = None
+            if EMOJI_MODE == "combined":
+                # Reaction rides along in the reply completion's [[emoji]] envelope.
+                chat_id, msg_id = u.effective_chat.id, u.message.message_id
+                on_reaction = lambda e: spawn_background(safe_react(c.bot, chat_id, msg_id, e or classify_emoji(text)))
+            else:
+                emoji = classify_emoji(text) if EMOJI_MODE == "local" else await ai_emoji(text)
+                try: await safe_react(c.bot, u.effective_chat.id, u.message.message_id, emoji)
+                except Exception: pass
 
             user_name = get_user_name(u.effective_user)
             memory = await get_user_memory(uid)
             mem_ctx = build_memory_context(memory)
             hist_ctx = build_chat_history_context(memory)
             system = f"{CHAT_PROMPT}\nThe user's name is {user_name}.{mem_ctx}{hist_ctx}"
-            reply = await ai(system, text, f"Hey {user_name}! 🐾", max_tok=140)
-
-            try:
-                await u.message.reply_text(reply, reply_to_message_id=u.message.message_id)
-            except Exception:
-                pass
+            async with ai_work("ambient", cid) as admitted:
+                if not admitted:
+                    bot_status["message_count"] += 1
+                    return
+                reply = await ai_stream_reply(u.message, system, text, f"Hey {user_name}! 🐾", max_tok=140, on_reaction=on_reaction)
 
             await append_chat_history(uid, text, reply)
 
@@ -2472,7 +4566,24 @@ async def monitor_group(u: Update, c: ContextTypes.DEFAULT_TYPE):
 
 async def _health(req):
     up = int((datetime.now() - bot_status["start_time"]).total_seconds())
-    return web.json_response({"status": "healthy", "uptime_seconds": up, "running": bot_status["running"], "messages": bot_status["message_count"], "version": "11.4.0"})
+    return web.json_response({"status": "healthy", "uptime_seconds": up, "running": bot_status["running"], "messages": bot_status["message_count"], "version": "11.4.0",
+                              "ai_http": ai_http_stats, "ai_stream": ai_stream_summary(),
+                              "ai_cache": ai_cache_summary(),
+                              "ai_race": ai_race_stats, "ai_rate": ai_rate_summary(),
+                              "emoji_classifier": emoji_classifier_stats, "reaction_envelope": envelope_stats,
+                              "single_flight": single_flight_stats, "ai_scheduler": ai_sched_summary(),
+                              "ai_providers": ai_breaker_summary(),
+                              "quiz_pool": {**quiz_pool_stats, "topics": len(quiz_pool), "ready": sum(len(p) for p in quiz_pool.values())},
+                              "leaderboard_flush": {**lb_flush_stats, "pending": len(_lb_dirty)},
+                              "chat_cache": {**chat_cache_stats, "chats": len(chat_cache), "entries": sum(len(st["scores"]) for st in chat_cache.values()), "max_entries": LB_CACHE_MAX},
+                              "score_cache": {**score_cache_stats, "size": len(score_cache), "max": LB_CACHE_MAX},
+                              "memory_cache": memory_cache_summary(), "storage": storage_summary(),
+                              "startup": startup_timing, "exchange": exchange_stats, "ohlcv": ohlcv_stats,
+                              "charts": chart_summary(),
+                              "ticker_snapshot": {**ticker_snapshot_stats, "symbols": len(ticker_snapshot["data"]),
+                                                  "age_s": round(time.time() - ticker_snapshot["ts"], 1) if ticker_snapshot["ts"] else None},
+                              "stickers": {**sticker_stats, "pool": len(sticker_index["pool"]), "banned": len(sticker_index["banned"])},
+                              "containers": {**bounded_stats, "mine_games": {"entries": len(mine_games)}}})
 
 async def _ping(req):
     return web.json_response({"pong": True, "ts": datetime.now().isoformat()})
@@ -2523,6 +4634,7 @@ WHAT_I_CAN_DO_TEXT = (
     "*💰 Crypto Live*\n"
     "`/price` — live coin price\n"
     "`/topgainers` `/toplosers` — market movers\n"
+    "`/screener` `/topvolume` `/topvolatile` — market screens\n"
     "`/chart` — candlestick chart\n\n"
     "*📰 News*\n"
     "`/news` — crypto headlines\n"
@@ -2633,52 +4745,141 @@ async def start_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 
 MEMORY_TTL_MESSAGES = 6
+MEMORY_CACHE_MAX = int(os.environ.get("MEMORY_CACHE_MAX", "2000"))
+MEMORY_WRITE_DELAY = float(os.environ.get("MEMORY_WRITE_DELAY", "3"))
+MEMORY_RETRY_MAX_SECS = 60
+
+# user_id -> memory doc. Misses are cached too (as an empty doc) so silent
+# users don't cost a find_one per message. Dirty entries hold the latest doc
+# until a flush has written it, and are never evicted.
+memory_cache: OrderedDict = OrderedDict()
+_memory_dirty: dict = {}
+_memory_flush_lock = asyncio.Lock()
+_memory_flush_task = None
+# Bumped by delete_user_memory (per key) and clear_all_memory (all keys) so a
+# storage read that was in flight across a delete doesn't re-cache the old doc.
+_memory_gens: dict = {}
+_memory_clears = 0
+memory_cache_stats = {"hits": 0, "misses": 0, "db_reads": 0, "db_writes": 0, "writes_coalesced": 0, "flush_failures": 0, "evictions": 0}
+
+def _storage_available() -> bool:
+    return storage is not None
+
+def _memory_cache_put(key: str, doc: dict):
+    memory_cache[key] = doc
+    memory_cache.move_to_end(key)
+    if len(memory_cache) <= MEMORY_CACHE_MAX:
+        return
+    for k in list(memory_cache):
+        if len(memory_cache) <= MEMORY_CACHE_MAX:
+            break
+        if k not in _memory_dirty:
+            del memory_cache[k]
+            memory_cache_stats["evictions"] += 1
+
+def _memory_write(key: str, doc: dict):
+    """Write-through into the cache; the storage write is deferred by
+    MEMORY_WRITE_DELAY so rapid-fire messages from one user collapse into one."""
+    global _memory_flush_task
+    if key in _memory_dirty:
+        memory_cache_stats["writes_coalesced"] += 1
+    _memory_dirty[key] = doc
+    _memory_cache_put(key, doc)
+    if _memory_flush_task is None or _memory_flush_task.done():
+        _memory_flush_task = asyncio.create_task(_flush_memory_later())
+
+async def _flush_memory_later():
+    """Flush after MEMORY_WRITE_DELAY, and keep going until nothing is dirty:
+    writes that landed mid-flush go out next round, failed batches are retried
+    with backoff (up to MEMORY_RETRY_MAX_SECS apart)."""
+    delay = MEMORY_WRITE_DELAY
+    while True:
+        await asyncio.sleep(delay)
+        ok = await flush_memory()
+        if not _memory_dirty:
+            return
+        delay = MEMORY_WRITE_DELAY if ok else min(delay * 2, MEMORY_RETRY_MAX_SECS)
+
+async def flush_memory() -> bool:
+    """Write every dirty memory doc in one bulk_write. Entries leave the dirty
+    set only once written (and only if not overwritten meanwhile). Returns
+    False if the write failed."""
+    if not _storage_available():
+        _memory_dirty.clear()
+        return True
+    async with _memory_flush_lock:
+        if not _memory_dirty:
+            return True
+        batch = dict(_memory_dirty)
+        try:
+            await storage_call("memory_put_many", batch)
+        except Exception as e:
+            memory_cache_stats["flush_failures"] += 1
+            logger.error(f"[storage flush_memory] ({len(batch)} docs) {e}")
+            return False
+        memory_cache_stats["db_writes"] += 1
+        for k, doc in batch.items():
+            if _memory_dirty.get(k) is doc:
+                del _memory_dirty[k]
+        return True
 
-def _mongo_available() -> bool:
-    return mongo_memory_col is not None
+def memory_cache_summary() -> dict:
+    st = memory_cache_stats
+    reads = st["hits"] + st["misses"]
+    return {**st, "size": len(memory_cache), "max": MEMORY_CACHE_MAX, "pending_writes": len(_memory_dirty),
+            "hit_rate": round(st["hits"] / reads, 3) if reads else 0.0,
+            "saved_round_trips": st["hits"] + st["writes_coalesced"]}
 
 async def get_user_memory(user_id) -> dict:
-    """Fetch a user's rolling chat memory from MongoDB. Returns {"messages": []} if none/unavailable."""
-    if not _mongo_available():
+    """Fetch a user's rolling chat memory (cache first, then storage). Returns {"messages": []} if none/unavailable."""
+    if not _storage_available():
         return {"messages": []}
+    key = str(user_id)
+    doc = memory_cache.get(key)
+    if doc is not None:
+        memory_cache_stats["hits"] += 1
+        memory_cache.move_to_end(key)
+        return doc
+    memory_cache_stats["misses"] += 1
+    gen = (_memory_clears, _memory_gens.get(key, 0))
     try:
-        doc = await mongo_memory_col.find_one({"_id": str(user_id)})
-        return doc if doc else {"messages": []}
+        doc = await storage_call("memory_get", key)
+        memory_cache_stats["db_reads"] += 1
     except Exception as e:
-        logger.error(f"[mongo get_user_memory] {e}")
+        logger.error(f"[storage get_user_memory] {e}")
+        return {"messages": []}
+    if key in memory_cache:  # written while the read was in flight; that copy is newer
+        return memory_cache[key]
+    if (_memory_clears, _memory_gens.get(key, 0)) != gen:  # deleted while the read was in flight
         return {"messages": []}
+    doc = doc if doc else {"messages": []}
+    _memory_cache_put(key, doc)
+    return doc
 
 async def save_user_memory(user_id, memory_data: dict) -> bool:
-    """Overwrite a user's full memory doc in MongoDB."""
-    if not _mongo_available():
-        return False
-    try:
-        await mongo_memory_col.replace_one({"_id": str(user_id)}, memory_data, upsert=True)
-        return True
-    except Exception as e:
-        logger.error(f"[mongo save_user_memory] {e}")
+    """Overwrite a user's full memory doc (cached now, written to storage by the next flush)."""
+    if not _storage_available():
         return False
+    _memory_write(str(user_id), memory_data)
+    return True
 
 async def append_chat_history(user_id, user_text: str, bot_reply: str) -> bool:
     """
     Store the current (user, bot) exchange as a user's memory.
-    The reply is generated using the PREVIOUS exchange (already in Mongo
+    The reply is generated using the PREVIOUS exchange (already cached
     before this call runs), then that previous exchange is discarded and
     replaced by the new one — so at any time only the most recent 2
-    messages (1 exchange) are remembered.
+    messages (1 exchange) are remembered. The storage write is coalesced
+    (see _memory_write).
     """
-    if not _mongo_available():
-        return False
-    try:
-        messages = [
-            {"role": "user", "text": user_text[:500], "ts": datetime.utcnow().isoformat()},
-            {"role": "bot", "text": bot_reply[:500], "ts": datetime.utcnow().isoformat()},
-        ]
-        await mongo_memory_col.replace_one({"_id": str(user_id)}, {"_id": str(user_id), "messages": messages}, upsert=True)
-        return True
-    except Exception as e:
-        logger.error(f"[mongo append_chat_history] {e}")
+    if not _storage_available():
         return False
+    messages = [
+        {"role": "user", "text": user_text[:500], "ts": datetime.utcnow().isoformat()},
+        {"role": "bot", "text": bot_reply[:500], "ts": datetime.utcnow().isoformat()},
+    ]
+    _memory_write(str(user_id), {"_id": str(user_id), "messages": messages})
+    return True
 
 def build_chat_history_context(memory: dict) -> str:
     """Turn the stored previous exchange (last 2 messages) into a short context block for the AI prompt."""
@@ -2696,25 +4897,35 @@ def build_memory_context(memory: dict) -> str:
     return ""
 
 async def delete_user_memory(user_id) -> bool:
-    if not _mongo_available():
-        return False
-    try:
-        await mongo_memory_col.delete_one({"_id": str(user_id)})
-        return True
-    except Exception as e:
-        logger.error(f"[mongo delete_user_memory] {e}")
+    if not _storage_available():
         return False
+    key = str(user_id)
+    async with _memory_flush_lock:  # an in-flight flush must not resurrect the doc
+        _memory_dirty.pop(key, None)
+        memory_cache.pop(key, None)
+        _memory_gens[key] = _memory_gens.get(key, 0) + 1
+        try:
+            await storage_call("memory_delete", key)
+            return True
+        except Exception as e:
+            logger.error(f"[storage delete_user_memory] {e}")
+            return False
 
 async def clear_all_memory() -> tuple:
-    """Wipe every user's memory doc from MongoDB. Returns (deleted_count, failed)."""
-    if not _mongo_available():
-        return (0, 1)
-    try:
-        result = await mongo_memory_col.delete_many({})
-        return (result.deleted_count, 0)
-    except Exception as e:
-        logger.error(f"[mongo clear_all_memory] {e}")
+    """Wipe every user's memory doc from storage and the cache. Returns (deleted_count, failed)."""
+    global _memory_clears
+    if not _storage_available():
         return (0, 1)
+    async with _memory_flush_lock:
+        _memory_dirty.clear()
+        memory_cache.clear()
+        _memory_gens.clear()
+        _memory_clears += 1
+        try:
+            return (await storage_call("memory_clear"), 0)
+        except Exception as e:
+            logger.error(f"[storage clear_all_memory] {e}")
+            return (0, 1)
 
 async def clearmemory_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
     if not u.message:
@@ -2725,9 +4936,9 @@ async def clearmemory_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
     status_msg = await u.message.reply_text("CLEARING MEMORY 🧹......")
     deleted, failed = await clear_all_memory()
     if failed == 0:
-        result_text = f"✅ Memory cleared! Removed {deleted} user record(s) from MongoDB."
+        result_text = f"✅ Memory cleared! Removed {deleted} user record(s) from {STORAGE_BACKEND}."
     else:
-        result_text = "⚠️ MongoDB not available or clear failed — check logs."
+        result_text = "⚠️ Storage not available or clear failed — check logs."
     try:
         await status_msg.edit_text(f"CLEARING MEMORY 🧹......\n\n{result_text}")
     except Exception:
@@ -2735,17 +4946,22 @@ async def clearmemory_handler(u: Update, c: ContextTypes.DEFAULT_TYPE):
 
 async def main():
     logger.info("STARTING BELUGA BOT v11.4.0")
+    start_chart_pool()
     http_runner = await start_http(HTTP_PORT)
+    startup_timing["port_bound_ms"] = _since_start_ms()
     await asyncio.sleep(0.3)
 
     app = TGApp.builder().token(BOT_TOKEN).build()
+    app.add_handler(TypeHandler(Update, _note_first_update), group=-1)
 
     await load_persistent_data()
+    await init_ai_sessions()
 
     app.add_handler(CommandHandler("start", start_handler))
     app.add_handler(CommandHandler("workflow", workflow_handler))
     app.add_handler(CommandHandler("price", crypto_price_handler))
     app.add_handler(CommandHandler(["topgainers", "toplosers"], crypto_movers_handler))
+    app.add_handler(CommandHandler(["screener", "topvolume", "topvolatile"], screener_handler))
     app.add_handler(CommandHandler(["chart", "chart5m", "chart15m", "chart1h", "chart4h", "chart1d"], crypto_chart_handler))
     app.add_handler(CommandHandler("news", lambda u, c: execute_news_flow(u, c, "crypto", "Crypto News")))
     app.add_handler(CommandHandler("ainews", lambda u, c: execute_news_flow(u, c, "ai", "AI News")))
@@ -2790,8 +5006,6 @@ async def main():
     await app.initialize()
     await app.start()
 
-    await load_sticker_pack(app.bot, STICKER_PACK_MAIN)
-    await load_sticker_pack(app.bot, STICKER_PACK_SAFE)
     await save_all_data()
 
     try:
@@ -2803,7 +5017,8 @@ async def main():
 
     await app.updater.start_polling(drop_pending_updates=True, allowed_updates=[])
     bot_status["running"] = True
-    logger.info("Beluga Bot is running")
+    startup_timing["polling_ms"] = _since_start_ms()
+    logger.info(f"Beluga Bot is running (port bound {startup_timing['port_bound_ms']}ms, polling {startup_timing['polling_ms']}ms after start)")
 
     stop_evt = asyncio.Event()
     try:
@@ -2815,16 +5030,25 @@ async def main():
         pass
 
     cleanup_task = asyncio.create_task(cleanup_expired_games())
+    quiz_pool_task = asyncio.create_task(quiz_pool_refiller())
+    sticker_task = asyncio.create_task(sticker_refresher(app.bot))
+    warm_task = asyncio.create_task(warm_heavy_imports()) if WARM_IMPORTS else None
     sync_task = asyncio.create_task(periodic_sync())
     exchange_task = asyncio.create_task(init_exchange_async())
+    ticker_task = asyncio.create_task(ticker_snapshot_refresher())
 
     await stop_evt.wait()
     logger.info("Shutting down...")
     cleanup_task.cancel()
+    quiz_pool_task.cancel()
+    sticker_task.cancel()
+    if warm_task:
+        warm_task.cancel()
     exchange_task.cancel()
+    ticker_task.cancel()
     sync_task.cancel()
     bot_status["running"] = False
-    for fn in [app.updater.stop, app.stop, app.shutdown, http_runner.cleanup]:
+    for fn in [app.updater.stop, app.stop, app.shutdown, save_all_data, close_ai_sessions, close_exchange, close_chart_pool, close_storage, http_runner.cleanup]:
         try:
             await fn()
         except Exception: